@@ -0,0 +1,433 @@
+#!/usr/bin/env python
+
+# A local stand-in for the bits of the Directory API that Federator uses:
+# users.get/list/patch/watch, channels.stop, schemas.list/get/insert/delete
+# and batch requests. users.list understands email and custom schema terms
+# in its query, as role migrate uses. Latency, error rate and quota are
+# configurable, so the benchmarks can be run without touching a real Google
+# Apps domain. Watch
+# channels get push notifications (to any http address) when users change,
+# including through console_edit() and delete_user(), which stand in for an
+# admin working in the Google console.
+#
+#   python benchmarks/fakedirectory.py --port 8099 --users 1000 --latency 0.05
+#
+# and point Federator at it with Federator.rootUrl = 'http://localhost:8099/'
+
+from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+from SocketServer import ThreadingMixIn
+import argparse
+import copy
+import email
+import json
+import os
+import random
+import re
+import shlex
+import socket
+import threading
+import time
+import urllib
+import urllib2
+import urlparse
+import uuid
+
+# Batch requests go wherever the discovery document Federator builds its
+# client from says; that's the copy bundled with Federator in the benchmarks,
+# but an older cached copy may still use the original path
+here = os.path.dirname(os.path.abspath(__file__))
+with open(os.path.join(here, '..', 'federator', 'documents', 'admin.directory_v1.json')) as document:
+    batchPaths = ['/' + json.load(document)['batchPath'], '/batch/admin/directory_v1']
+servicePath = '/admin/directory/v1/'
+
+class Directory(object):
+    def __init__(self, latency=0.0, errorRate=0.0, quota=None):
+        self.users = {}
+        self.schemas = {}
+        self.latency = latency
+        self.errorRate = errorRate
+        # quota is in queries per 100 seconds, like the real thing
+        self.quota = quota
+        self.window = []
+        self.lock = threading.Lock()
+        self.version = 0
+        # {channel id: channel}
+        self.channels = {}
+        self.notifications = 0
+        # set to refuse new watch channels, e.g. to exercise fallbacks
+        self.refuseWatch = False
+
+    def next_etag(self):
+        self.version += 1
+        return '"fake/%d"' % self.version
+
+    def add_user(self, email, sso=None):
+        user = {'kind': 'admin#directory#user', 'primaryEmail': email, 'id': str(len(self.users) + 1)}
+        if sso is not None:
+            user['customSchemas'] = {'AWS-SSO': sso}
+        user['etag'] = self.next_etag()
+        self.users[email.lower()] = user
+        self.notify('add', user)
+        return user
+
+    def console_edit(self, email, sso):
+        # Change a user's AWS-SSO block behind Federator's back
+        with self.lock:
+            user = self.users[email.lower()]
+            user.setdefault('customSchemas', {})['AWS-SSO'] = copy.deepcopy(sso)
+            user['etag'] = self.next_etag()
+            self.notify('update', user)
+            return user
+
+    def delete_user(self, email):
+        with self.lock:
+            user = self.users.pop(email.lower())
+            self.notify('delete', user)
+
+    def watch(self, query, body):
+        if self.refuseWatch:
+            return self.error(403, 'forbidden', 'Push notifications are not allowed')
+        request = json.loads(body)
+        ttl = int(request.get('params', {}).get('ttl', 21600))
+        channel = {'kind': 'api#channel', 'id': request['id'], 'resourceId': uuid.uuid4().hex,
+                   'resourceUri': 'https://www.googleapis.com/admin/directory/v1/users?event=%s' % query.get('event'),
+                   'address': request['address'], 'token': request.get('token'), 'event': query.get('event'),
+                   'expiration': str(int((time.time() + ttl) * 1000)), 'messages': 0}
+        self.channels[channel['id']] = channel
+        self.send(channel, 'sync', {})
+        return 200, json.dumps(dict((key, channel[key]) for key in ('kind', 'id', 'resourceId', 'resourceUri', 'expiration')))
+
+    def stop(self, body):
+        request = json.loads(body)
+        channel = self.channels.get(request.get('id'))
+        if channel is None or channel['resourceId'] != request.get('resourceId'):
+            return self.error(404, 'notFound', 'Channel not found')
+        del self.channels[request['id']]
+        return 204, ''
+
+    def expire_channels(self):
+        # As if every channel had run out
+        with self.lock:
+            self.channels.clear()
+
+    def notify(self, event, user):
+        for channel in self.channels.values():
+            if channel['event'] in (None, event):
+                self.send(channel, event, user)
+
+    def send(self, channel, state, user):
+        # POST the notification from another thread, like Google would
+        channel['messages'] += 1
+        self.notifications += 1
+        headers = {'Content-Type': 'application/json; charset=UTF-8',
+                   'X-Goog-Channel-ID': channel['id'], 'X-Goog-Channel-Token': channel['token'] or '',
+                   'X-Goog-Channel-Expiration': channel['expiration'], 'X-Goog-Resource-ID': channel['resourceId'],
+                   'X-Goog-Resource-URI': channel['resourceUri'], 'X-Goog-Resource-State': state,
+                   'X-Goog-Message-Number': str(channel['messages'])}
+        body = json.dumps(dict((key, user[key]) for key in ('kind', 'id', 'etag', 'primaryEmail') if user.has_key(key)))
+
+        def post():
+            try:
+                urllib2.urlopen(urllib2.Request(channel['address'], body, headers), timeout=10).read()
+            except Exception:
+                pass
+
+        thread = threading.Thread(target=post)
+        thread.daemon = True
+        thread.start()
+
+    def seed(self, count, rolesPerUser=2, accounts=5):
+        for i in range(count):
+            roles = []
+            for j in range(rolesPerUser):
+                account = '%012d' % (100000000000 + (i + j) % accounts)
+                name = 'Role%d' % ((i + j) % 7)
+                roles.append({
+                    'value': 'arn:aws:iam::%s:role/%s,arn:aws:iam::%s:saml-provider/Google' % (account, name, account),
+                    'customType': '%s-%s' % (account, name),
+                })
+            self.add_user('user%d@example.com' % i, {'role': roles, 'duration': 3600})
+
+    def over_quota(self):
+        if self.quota is None:
+            return False
+
+        with self.lock:
+            now = time.time()
+            self.window = [stamp for stamp in self.window if now - stamp < 100]
+            if len(self.window) >= self.quota:
+                return True
+            self.window.append(now)
+            return False
+
+    @staticmethod
+    def error(status, reason, message):
+        return status, json.dumps({'error': {'code': status, 'message': message,
+            'errors': [{'domain': 'global', 'reason': reason, 'message': message}]}})
+
+    def handle(self, method, path, query, headers, body):
+        # Returns (status, body) for a single API call
+        if self.over_quota():
+            return self.error(403, 'userRateLimitExceeded', 'Rate limit exceeded')
+
+        if self.errorRate and random.random() < self.errorRate:
+            return self.error(503, 'backendError', 'Backend Error')
+
+        if path.endswith('/channels/stop') and method == 'POST':
+            with self.lock:
+                return self.stop(body)
+
+        if not path.startswith(servicePath):
+            return self.error(404, 'notFound', 'Not Found')
+
+        parts = [urllib.unquote(part) for part in path[len(servicePath):].split('/')]
+        with self.lock:
+            if parts == ['users', 'watch'] and method == 'POST':
+                return self.watch(query, body)
+            if parts[0] == 'users':
+                if len(parts) == 1 and method == 'GET':
+                    return self.list_users(query)
+                if len(parts) == 2:
+                    return self.user(method, parts[1], headers, body)
+
+            if parts[0] == 'customer' and len(parts) >= 3 and parts[2] == 'schemas':
+                return self.schema(method, parts[3] if len(parts) > 3 else None, body)
+
+        return self.error(404, 'notFound', 'Not Found')
+
+    queryTerm = re.compile(r'^(email|[\w-]+\.\w+)([:=])(.+)$')
+
+    @classmethod
+    def matcher(cls, search):
+        # The subset of the users.list query language Federator uses: space
+        # separated terms that must all match, each on email or on a custom
+        # schema field ('AWS-SSO.role'). '=' is an exact match; ':' matches
+        # a prefix ending in * on email, or any value containing the text on
+        # a custom field. Values may be quoted. Returns None for anything else.
+        terms = []
+        for term in shlex.split(search):
+            parsed = cls.queryTerm.match(term)
+            if parsed is None:
+                return None
+            terms.append(parsed.groups())
+
+        def matches(found, operator, value):
+            if operator == '=':
+                return found == value
+            if value.endswith('*'):
+                return found.startswith(value[:-1])
+            return value in found
+
+        def match(user):
+            for field, operator, value in terms:
+                if field == 'email':
+                    # email:<address> is exact unless it ends in *
+                    exact = '=' if not value.endswith('*') else operator
+                    if not matches(user['primaryEmail'].lower(), exact, value.lower()):
+                        return False
+                    continue
+
+                schema, name = field.split('.')
+                values = user.get('customSchemas', {}).get(schema, {}).get(name)
+                if not isinstance(values, list):
+                    values = [] if values is None else [{'value': values}]
+                if not any(matches(unicode(item.get('value')), operator, value) for item in values):
+                    return False
+            return True
+
+        return match
+
+    def list_users(self, query):
+        keys = sorted(self.users)
+        if query.get('query'):
+            match = self.matcher(query['query'])
+            if match is None:
+                return self.error(400, 'invalid', 'Invalid Input: %s' % query['query'])
+            keys = [key for key in keys if match(self.users[key])]
+
+        start = int(query.get('pageToken', 0))
+        size = int(query.get('maxResults', 100))
+        response = {'kind': 'admin#directory#users', 'users': [self.users[key] for key in keys[start:start + size]]}
+        if start + size < len(keys):
+            response['nextPageToken'] = str(start + size)
+
+        return 200, json.dumps(response)
+
+    def user(self, method, userKey, headers, body):
+        user = self.users.get(userKey.lower())
+        if user is None:
+            return self.error(404, 'notFound', 'Resource Not Found: userKey')
+
+        if method == 'GET':
+            if headers.get('if-none-match') == user['etag']:
+                return 304, ''
+            return 200, json.dumps(user)
+
+        if method in ('PATCH', 'PUT'):
+            if headers.has_key('if-match') and headers['if-match'] != user['etag']:
+                return self.error(412, 'conditionNotMet', 'Precondition Failed')
+            for key, value in json.loads(body).items():
+                if key == 'customSchemas':
+                    # each custom schema is replaced as a whole, but other
+                    # schemas on the user are left alone
+                    user.setdefault('customSchemas', {}).update(copy.deepcopy(value))
+                else:
+                    user[key] = copy.deepcopy(value)
+            user['etag'] = self.next_etag()
+            self.notify('update', user)
+            return 200, json.dumps(user)
+
+        return self.error(405, 'notAllowed', 'Method Not Allowed')
+
+    def schema(self, method, schemaKey, body):
+        if schemaKey is None:
+            if method == 'GET':
+                return 200, json.dumps({'kind': 'admin#directory#schemas', 'schemas': self.schemas.values()})
+            if method == 'POST':
+                schema = json.loads(body)
+                if self.schemas.has_key(schema['schemaName']):
+                    return self.error(412, 'conditionNotMet', 'Schema already exists')
+                schema['kind'] = 'admin#directory#schema'
+                schema['etag'] = self.next_etag()
+                self.schemas[schema['schemaName']] = schema
+                return 200, json.dumps(schema)
+
+        elif self.schemas.has_key(schemaKey):
+            if method == 'GET':
+                return 200, json.dumps(self.schemas[schemaKey])
+            if method == 'DELETE':
+                del self.schemas[schemaKey]
+                return 204, ''
+
+        return self.error(404, 'notFound', 'Resource Not Found: schemaKey')
+
+class Handler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    reasons = {200: 'OK', 204: 'No Content', 304: 'Not Modified', 403: 'Forbidden', 404: 'Not Found',
+               405: 'Method Not Allowed', 412: 'Precondition Failed', 503: 'Service Unavailable'}
+
+    def log_message(self, format, *args):
+        pass
+
+    def respond(self, status, body, contentType='application/json; charset=UTF-8'):
+        self.send_response(status)
+        self.send_header('Content-Type', contentType)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def dispatch(self):
+        directory = self.server.directory
+        if directory.latency:
+            time.sleep(directory.latency)
+
+        length = int(self.headers.get('content-length', 0))
+        body = self.rfile.read(length) if length else ''
+        url = urlparse.urlparse(self.path)
+
+        if url.path in batchPaths:
+            return self.batch(body)
+
+        query = dict(urlparse.parse_qsl(url.query))
+        headers = dict((key.lower(), value) for key, value in self.headers.items())
+        status, content = directory.handle(self.command, url.path, query, headers, body)
+        self.respond(status, content)
+
+    do_GET = do_POST = do_PATCH = do_PUT = do_DELETE = dispatch
+
+    def batch(self, body):
+        # multipart/mixed in, multipart/mixed out; each part is a whole HTTP
+        # request or response
+        message = email.message_from_string('Content-Type: %s\r\n\r\n%s' % (self.headers['content-type'], body))
+        boundary = 'batch_fake_%d' % random.randint(0, 1 << 30)
+        out = []
+        for part in message.get_payload():
+            raw = part.get_payload()
+            head, _, content = re.split(r'(\r?\n\r?\n)', raw, 1)
+            lines = head.splitlines()
+            method, target = lines[0].split(' ')[:2]
+            headers = {}
+            for line in lines[1:]:
+                key, _, value = line.partition(':')
+                headers[key.strip().lower()] = value.strip()
+
+            url = urlparse.urlparse(target)
+            status, result = self.server.directory.handle(method, url.path, dict(urlparse.parse_qsl(url.query)), headers, content)
+            contentId = part['Content-ID'] or ''
+            out.append('--%s\r\nContent-Type: application/http\r\nContent-ID: <response-%s>\r\n\r\n'
+                       'HTTP/1.1 %d %s\r\nContent-Type: application/json; charset=UTF-8\r\nContent-Length: %d\r\n\r\n%s\r\n'
+                       % (boundary, contentId.strip('<>'), status, self.reasons.get(status, 'Error'), len(result), result))
+
+        out.append('--%s--\r\n' % boundary)
+        self.respond(200, ''.join(out), contentType='multipart/mixed; boundary=%s' % boundary)
+
+class Server(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+    def __init__(self, directory, port=0):
+        HTTPServer.__init__(self, ('127.0.0.1', port), Handler)
+        self.directory = directory
+        self.stopped = False
+        # open connections, so shutdown can close kept-alive ones rather than
+        # leave their threads to die noisily with the interpreter
+        self.active = set()
+        self.activeLock = threading.Lock()
+
+    def process_request_thread(self, request, client_address):
+        with self.activeLock:
+            self.active.add(request)
+        try:
+            ThreadingMixIn.process_request_thread(self, request, client_address)
+        finally:
+            with self.activeLock:
+                self.active.discard(request)
+
+    def shutdown(self):
+        self.stopped = True
+        HTTPServer.shutdown(self)
+        with self.activeLock:
+            active = list(self.active)
+        for request in active:
+            try:
+                request.shutdown(socket.SHUT_RDWR)
+            except socket.error:
+                pass
+        deadline = time.time() + 5
+        while self.active and time.time() < deadline:
+            time.sleep(0.01)
+
+    def handle_error(self, request, client_address):
+        # clients dropping their connections as the benchmark exits aren't
+        # worth a traceback
+        if not self.stopped:
+            HTTPServer.handle_error(self, request, client_address)
+
+    @property
+    def rootUrl(self):
+        return 'http://127.0.0.1:%d/' % self.server_address[1]
+
+def start(directory, port=0):
+    # Run the server on a background thread; returns it
+    server = Server(directory, port=port)
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    return server
+
+def main():
+    parser = argparse.ArgumentParser(description="Local stand-in for the Google Directory API")
+    parser.add_argument("--port", type=int, default=8099)
+    parser.add_argument("--users", type=int, default=1000, help="Number of users to seed")
+    parser.add_argument("--latency", type=float, default=0.0, help="Seconds to wait before answering each request")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="Fraction of calls that fail with a 503")
+    parser.add_argument("--quota", type=int, help="Queries per 100 seconds before answering 403 userRateLimitExceeded")
+    args = parser.parse_args()
+
+    directory = Directory(latency=args.latency, errorRate=args.error_rate, quota=args.quota)
+    directory.seed(args.users)
+    server = Server(directory, port=args.port)
+    print("Fake Directory API listening on %s" % server.rootUrl)
+    server.serve_forever()
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,116 @@
+#!/usr/bin/env python
+
+# Measure ops/sec and p50/p99 latency of Federator's hot paths against the
+# local fake Directory API in fakedirectory.py, so regressions show up
+# without needing a real Google Apps domain or credentials.
+#
+#   python benchmarks/hotpaths.py --users 2000 --latency 0.01
+
+import argparse
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+here = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(here, '..'))
+sys.path.insert(0, here)
+
+import fakedirectory
+from federator import federator, bulk, discovery, report
+
+class FakeCredentials(object):
+    # Enough of an oauth2client credential for the API client, which checks
+    # and applies the token itself when it sends a batch
+    access_token = 'fake-token'
+    access_token_expired = False
+
+    def authorize(self, http):
+        return http
+
+    def apply(self, headers):
+        headers['authorization'] = 'Bearer ' + self.access_token
+
+    def refresh(self, http):
+        pass
+
+def use_fake(rootUrl, store, quota):
+    # Start from a cached discovery document, like any run after the first
+    discovery.write_cache(store, discovery.static_document(), None)
+    federator.Federator.rootUrl = rootUrl
+    federator.Federator.storePath = store
+    federator.Federator.discoveryOffline = True
+    federator.Federator.quota = quota
+    federator.Federator.load_credentials = lambda self, store, **kwargs: FakeCredentials()
+
+def percentile(samples, fraction):
+    ordered = sorted(samples)
+    return ordered[min(len(ordered) - 1, int(len(ordered) * fraction))]
+
+def measure(name, func, count):
+    # call func(i) count times; report per-call latency
+    samples = []
+    start = time.time()
+    for i in range(count):
+        begin = time.time()
+        func(i)
+        samples.append(time.time() - begin)
+    elapsed = time.time() - start
+
+    print("%-24s %8d %10.1f %10.2f %10.2f" % (name, count, count / elapsed,
+        percentile(samples, 0.5) * 1000, percentile(samples, 0.99) * 1000))
+
+def measure_bulk(name, func, ops):
+    # one call that does `ops` operations
+    start = time.time()
+    func()
+    elapsed = time.time() - start
+    print("%-24s %8d %10.1f %10.2f %10s" % (name, ops, ops / elapsed, elapsed * 1000, '-'))
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark Federator against a local fake Directory API")
+    parser.add_argument("--users", type=int, default=1000, help="Number of users in the fake directory")
+    parser.add_argument("--count", type=int, default=200, help="Calls per single-user benchmark")
+    parser.add_argument("--latency", type=float, default=0.0, help="Fake server latency per HTTP request, in seconds")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="Fraction of fake server calls that fail with a 503")
+    parser.add_argument("--server-quota", type=int, help="Fake server quota, in queries per 100 seconds")
+    parser.add_argument("--quota", type=int, default=10 ** 9, help="Federator's own quota, in queries per 100 seconds")
+    args = parser.parse_args()
+
+    directory = fakedirectory.Directory(latency=args.latency, errorRate=args.error_rate, quota=args.server_quota)
+    directory.seed(args.users)
+    server = fakedirectory.start(directory)
+    store = tempfile.mkdtemp()
+    use_fake(server.rootUrl, store, args.quota)
+
+    roleArn = 'arn:aws:iam::123456789012:role/Bench'
+    providerArn = 'arn:aws:iam::123456789012:saml-provider/Bench'
+    count = min(args.count, args.users)
+
+    try:
+        print("%-24s %8s %10s %10s %10s" % ("benchmark", "ops", "ops/sec", "p50 ms", "p99 ms"))
+
+        measure("startup User", lambda i: federator.User(userKey='user0@example.com'), 20)
+        measure("startup Schema", lambda i: federator.Schema(customerId='my_customer'), 20)
+
+        users = [federator.User(userKey='user%d@example.com' % i) for i in range(count)]
+        measure("User.add_role", lambda i: users[i].add_role(roleArn=roleArn, providerArn=providerArn), count)
+        measure("User.remove_role", lambda i: users[i].remove_role(roleArn=roleArn, providerArn=providerArn), count)
+
+        schema = federator.Schema(customerId='my_customer')
+        schema.create()
+        measure("Schema.exists", lambda i: schema.exists(), count)
+
+        rows = [{'userKey': 'user%d@example.com' % i, 'roleArn': roleArn, 'providerArn': providerArn, 'action': 'add'}
+                for i in range(args.users)]
+        measure_bulk("Bulk.apply", lambda: bulk.Bulk().apply(rows), len(rows))
+
+        roles = report.Report()
+        measure_bulk("Report.iter_roles", lambda: sum(1 for record in roles.iter_roles()), args.users)
+    finally:
+        server.shutdown()
+        shutil.rmtree(store)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,70 @@
+#!/usr/bin/env python
+
+# Guard against `federator --help` (and argument errors, and --server calls)
+# getting slow again: run the CLI entry point in a fresh interpreter and fail
+# if it loaded any of the heavy Google API client modules, or took longer
+# than the budget.
+#
+#   python benchmarks/importtime.py [--budget 0.3]
+
+import argparse
+import os
+import subprocess
+import sys
+
+root = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+
+heavy = ['apiclient', 'googleapiclient', 'oauth2client', 'httplib2', 'Crypto']
+
+probe = """
+import sys, time
+start = time.time()
+sys.argv = %r
+import federator
+try:
+    federator.main()
+except SystemExit:
+    pass
+elapsed = time.time() - start
+sys.stderr.write("%%f\\n" %% elapsed)
+sys.stderr.write(" ".join(sorted(sys.modules)) + "\\n")
+"""
+
+def run(argv):
+    # Returns (seconds, set of loaded module names)
+    process = subprocess.Popen([sys.executable, '-c', probe % (argv,)], cwd=root,
+            stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    stdout, stderr = process.communicate()
+    lines = stderr.strip().splitlines()
+    return float(lines[-2]), set(lines[-1].split())
+
+def main():
+    parser = argparse.ArgumentParser(description="Check that the federator CLI starts quickly")
+    parser.add_argument("--budget", type=float, default=0.3, help="Seconds allowed for each command (default 0.3)")
+    parser.add_argument("--rounds", type=int, default=3, help="Best of this many runs is compared to the budget")
+    args = parser.parse_args()
+
+    failed = False
+    for argv in (['federator', '--help'], ['federator', 'user', '--help'], ['federator', 'no-such-command']):
+        times = []
+        for i in range(args.rounds):
+            elapsed, modules = run(argv)
+            times.append(elapsed)
+
+        loaded = [name for name in heavy if name in modules]
+        best = min(times)
+        status = 'ok'
+        if loaded:
+            status = 'FAIL: loaded %s' % ', '.join(loaded)
+            failed = True
+        elif best > args.budget:
+            status = 'FAIL: over budget of %.3fs' % args.budget
+            failed = True
+
+        print("%-40s %8.3fs  %s" % (' '.join(argv), best, status))
+
+    if failed:
+        sys.exit(1)
+
+if __name__ == "__main__":
+    main()
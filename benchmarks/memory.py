@@ -0,0 +1,110 @@
+#!/usr/bin/env python
+
+# Measure the peak memory needed to hold a directory's worth of AWS-SSO role
+# data, as plain dicts from json.loads and as a compact.Snapshot, and to diff
+# it against a desired state. Each representation is built in a fresh
+# interpreter so their peaks don't mix. Fails if the compact one goes over
+# the budget.
+#
+#   python benchmarks/memory.py --users 500000 --budget 400
+
+import argparse
+import json
+import os
+import random
+import resource
+import subprocess
+import sys
+import time
+
+here = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(here, '..'))
+
+def users(count, accounts, rolesPerUser, seed=1):
+    # Yields (userKey, JSON of the AWS-SSO block), drawing roles from a small
+    # pool as a real organisation would
+    rng = random.Random(seed)
+    pool = []
+    for account in range(accounts):
+        accountId = '%012d' % (100000000000 + account)
+        for name in ('Admin', 'Developer', 'ReadOnly', 'Billing'):
+            value = 'arn:aws:iam::%s:role/%s,arn:aws:iam::%s:saml-provider/Google' % (accountId, name, accountId)
+            pool.append({'value': value, 'customType': '%s-%s' % (accountId, name)})
+
+    for i in range(count):
+        block = {'role': rng.sample(pool, rolesPerUser), 'duration': rng.choice([3600, 7200, 43200])}
+        yield 'user%07d@example.com' % i, json.dumps(block)
+
+def peak_mb():
+    # ru_maxrss is in kilobytes on Linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.0
+
+def build(mode, args):
+    from federator import compact
+
+    start = time.time()
+    if mode == 'dicts':
+        current = {}
+        for userKey, block in users(args.users, args.accounts, args.roles):
+            current[userKey] = json.loads(block)
+        desired = {}
+        for userKey, block in users(args.users, args.accounts, args.roles, seed=2):
+            desired[userKey] = json.loads(block)
+        changed = 0
+        for userKey in sorted(desired):
+            have = set(role['value'] for role in current.get(userKey, {}).get('role', []))
+            want = set(role['value'] for role in desired[userKey]['role'])
+            if have != want:
+                changed += 1
+    else:
+        current = compact.Snapshot()
+        for userKey, block in users(args.users, args.accounts, args.roles):
+            current.add(userKey, json.loads(block))
+        desired = compact.Snapshot(current.roles)
+        for userKey, block in users(args.users, args.accounts, args.roles, seed=2):
+            desired.add(userKey, json.loads(block))
+        changed = 0
+        for userKey, i, j, added, removed in current.diff(desired):
+            if added or removed:
+                changed += 1
+
+    return time.time() - start, changed
+
+def measure(mode, args):
+    # Run build() in a fresh interpreter; returns (peak MB, seconds, changed)
+    process = subprocess.Popen([sys.executable, __file__, '--mode', mode,
+            '--users', str(args.users), '--accounts', str(args.accounts), '--roles', str(args.roles)],
+            stdout=subprocess.PIPE)
+    stdout, _ = process.communicate()
+    if process.returncode != 0:
+        raise RuntimeError("%s run failed" % mode)
+    return json.loads(stdout)
+
+def main():
+    parser = argparse.ArgumentParser(description="Measure the memory used by directory-scale role data")
+    parser.add_argument("--users", type=int, default=500000, help="Number of users (default 500000)")
+    parser.add_argument("--accounts", type=int, default=50, help="Number of AWS accounts roles are drawn from")
+    parser.add_argument("--roles", type=int, default=3, help="Roles per user")
+    parser.add_argument("--budget", type=float, default=400, help="Peak MB allowed for the compact representation")
+    parser.add_argument("--compact-only", action="store_true", help="Skip the (much larger) plain dict run")
+    parser.add_argument("--mode", choices=['dicts', 'compact'], help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.mode is not None:
+        elapsed, changed = build(args.mode, args)
+        print(json.dumps([peak_mb(), elapsed, changed]))
+        return
+
+    print("%d users, %d roles each from %d accounts" % (args.users, args.roles, args.accounts))
+    results = {}
+    for mode in (['compact'] if args.compact_only else ['dicts', 'compact']):
+        peak, elapsed, changed = measure(mode, args)
+        results[mode] = peak
+        print("%-10s %10.1f MB peak %8.2fs  %d users differ" % (mode, peak, elapsed, changed))
+
+    if results['compact'] > args.budget:
+        print("FAIL: compact representation over budget of %.0f MB" % args.budget)
+        sys.exit(1)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,53 @@
+#!/usr/bin/env python
+
+# Time how long it takes to construct User and Schema objects, with the
+# discovery document cache empty (cold), only on disk (disk, as a new process
+# finds it) and already loaded by this process (warm). Needs working
+# credentials under ~/.federator, i.e. `federator init` must have been run.
+
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from federator import federator, discovery
+
+def forget_loaded():
+    # the copy discovery keeps in memory for the rest of the process
+    discovery.loaded.clear()
+
+def clear_cache():
+    forget_loaded()
+    store = os.path.expanduser('~/.federator')
+    for path in discovery.cache_paths(store):
+        if os.path.exists(path):
+            os.unlink(path)
+
+def timed(cls, **kwargs):
+    start = time.time()
+    cls(**kwargs)
+    return time.time() - start
+
+def main():
+    rounds = int(sys.argv[1]) if len(sys.argv) > 1 else 5
+    print("%-8s %-6s %10s" % ("class", "cache", "seconds"))
+    for cls, kwargs in ((federator.User, {'userKey': None}), (federator.Schema, {'customerId': None})):
+        cold = []
+        for i in range(rounds):
+            clear_cache()
+            cold.append(timed(cls, **kwargs))
+
+        disk = []
+        for i in range(rounds):
+            forget_loaded()
+            disk.append(timed(cls, **kwargs))
+
+        warm = [timed(cls, **kwargs) for i in range(rounds)]
+
+        print("%-8s %-6s %10.3f" % (cls.__name__, "cold", min(cold)))
+        print("%-8s %-6s %10.3f" % (cls.__name__, "disk", min(disk)))
+        print("%-8s %-6s %10.3f" % (cls.__name__, "warm", min(warm)))
+
+if __name__ == "__main__":
+    main()
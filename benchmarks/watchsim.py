@@ -0,0 +1,141 @@
+#!/usr/bin/env python
+
+# Simulate admins editing users in the Google console while a Watcher keeps
+# the local role index fresh from push notifications, using the fake
+# Directory API in fakedirectory.py to send them. Reports how long each edit
+# takes to show up in `role members` lookups, first over push channels, then
+# with channels refused and expired (so the watcher falls back to polling),
+# then with push restored. Fails if the index ends up disagreeing with the
+# directory.
+#
+#   python benchmarks/watchsim.py --users 500 --edits 50
+
+import argparse
+import os
+import random
+import shutil
+import sys
+import tempfile
+import threading
+import time
+
+here = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(here, '..'))
+sys.path.insert(0, here)
+
+import fakedirectory
+import hotpaths
+from federator import index, watch
+
+roleArn = 'arn:aws:iam::123456789012:role/Watched'
+providerArn = 'arn:aws:iam::123456789012:saml-provider/Google'
+role = {'value': roleArn + ',' + providerArn, 'customType': '123456789012-Watched'}
+
+def run_watcher(receiver, store, stop, ready):
+    # The watcher and its receiver on their own thread, as `federator watch`
+    # would run them; the SQLite index belongs to this thread
+    watcher = watch.Watcher(address='http://127.0.0.1:%d/' % receiver.server_address[1])
+    receiver.watcher = watcher
+    watcher.renew()
+    if not watcher.lastPoll:
+        watcher.poll()
+    ready.set()
+    try:
+        while not stop.is_set():
+            receiver.handle_request()
+            watcher.tick()
+    finally:
+        receiver.server_close()
+        watcher.close()
+
+def wait_for(lookup, userKey, present, timeout):
+    # Seconds until the index agrees, or None if it never did
+    start = time.time()
+    while time.time() - start < timeout:
+        if (userKey in lookup.members(roleArn)) == present:
+            return time.time() - start
+        time.sleep(0.01)
+    return None
+
+def phase(name, directory, lookup, edits, timeout):
+    samples = []
+    missed = 0
+    keys = sorted(directory.users)
+    for i in range(edits):
+        userKey = random.choice(keys)
+        sso = directory.users[userKey].get('customSchemas', {}).get('AWS-SSO', {'role': []})
+        has = role in sso.get('role', [])
+        roles = [entry for entry in sso.get('role', []) if entry != role] if has else sso.get('role', []) + [role]
+        directory.console_edit(userKey, {'role': roles, 'duration': sso.get('duration', 3600)})
+        elapsed = wait_for(lookup, userKey, not has, timeout)
+        if elapsed is None:
+            missed += 1
+        else:
+            samples.append(elapsed)
+
+    if samples:
+        print("%-24s %8d %8d %10.1f %10.1f" % (name, edits, missed,
+            hotpaths.percentile(samples, 0.5) * 1000, hotpaths.percentile(samples, 0.99) * 1000))
+    else:
+        print("%-24s %8d %8d %10s %10s" % (name, edits, missed, '-', '-'))
+    return missed
+
+def main():
+    parser = argparse.ArgumentParser(description="Simulate push-notification cache invalidation against a fake Directory API")
+    parser.add_argument("--users", type=int, default=500, help="Number of users in the fake directory")
+    parser.add_argument("--edits", type=int, default=50, help="Console edits per phase")
+    parser.add_argument("--poll-interval", type=float, default=1.0, help="Watcher poll interval while there are no channels, in seconds")
+    parser.add_argument("--channel-ttl", type=int, default=4, help="Lifetime of each watch channel, in seconds")
+    args = parser.parse_args()
+
+    directory = fakedirectory.Directory()
+    directory.seed(args.users)
+    server = fakedirectory.start(directory)
+    store = tempfile.mkdtemp()
+    hotpaths.use_fake(server.rootUrl, store, 10 ** 9)
+
+    watch.Watcher.channelTtl = args.channel_ttl
+    watch.Watcher.renewMargin = 1
+    watch.Watcher.pollInterval = args.poll_interval
+
+    receiver = watch.Receiver(('127.0.0.1', 0), None)
+    stop = threading.Event()
+    ready = threading.Event()
+    thread = threading.Thread(target=run_watcher, args=(receiver, store, stop, ready))
+    thread.daemon = True
+    thread.start()
+    ready.wait()
+
+    lookup = index.RoleIndex(store)
+    timeout = args.poll_interval + args.channel_ttl + 5
+    missed = 0
+    try:
+        print("%-24s %8s %8s %10s %10s" % ("phase", "edits", "missed", "p50 ms", "p99 ms"))
+        missed += phase("push", directory, lookup, args.edits, timeout)
+
+        directory.refuseWatch = True
+        directory.expire_channels()
+        # let the watcher's own idea of its channels run out too
+        time.sleep(args.channel_ttl)
+        missed += phase("polling fallback", directory, lookup, args.edits, timeout)
+
+        directory.refuseWatch = False
+        time.sleep(args.poll_interval + 0.5)
+        missed += phase("push restored", directory, lookup, args.edits, timeout)
+
+        expected = sorted(key for key, user in directory.users.items()
+                          if role in user.get('customSchemas', {}).get('AWS-SSO', {}).get('role', []))
+        consistent = lookup.members(roleArn) == expected
+        print("%d notifications sent; index %s the directory" % (directory.notifications,
+            "matches" if consistent else "DOES NOT MATCH"))
+    finally:
+        stop.set()
+        thread.join()
+        server.shutdown()
+        shutil.rmtree(store)
+
+    if missed or not consistent:
+        sys.exit(1)
+
+if __name__ == "__main__":
+    main()
@@ -1,14 +1,26 @@
 #!/usr/bin/env python
 
-import federator
+# Only the standard library is imported here, so that `federator --help`,
+# argument errors and --server calls don't have to load the Google API
+# client. Each command imports what it needs when it runs.
+import client
+import httplib
+import metrics
+import os
 import sys
 import argparse
+import atexit
 
 def init(args):
+    import federator
     args = vars(args)
     federator.Federator(clientId=args['clientid'], clientSecret=args['clientsecret'])
+    if args['groups']:
+        import groups
+        groups.GroupMapping(clientId=args['clientid'], clientSecret=args['clientsecret'])
 
 def schema_verify(args):
+    import federator
     args = vars(args)
     schema = federator.Schema(customerId=args['customerid'])
     if schema.exists():
@@ -18,6 +30,7 @@ def schema_verify(args):
         sys.exit(1)
 
 def schema_create(args):
+    import federator
     args = vars(args)
     schema = federator.Schema(customerId=args['customerid'])
     if schema.exists():
@@ -26,10 +39,11 @@ def schema_create(args):
     if schema.create():
         print("Created custom SSO schema")
     else:
-        print("Could not create custom SSO schema")
+        print("Schema already exists")
         sys.exit(1)
 
 def schema_delete(args):
+    import federator
     args = vars(args)
     schema = federator.Schema(customerId=args['customerid'])
     if not schema.exists():
@@ -42,6 +56,7 @@ def schema_delete(args):
         sys.exit(1)
 
 def schema_show(args):
+    import federator
     args = vars(args)
     schema = federator.Schema(customerId=args['customerid'])
     if not schema.exists():
@@ -49,20 +64,26 @@ def schema_show(args):
 
     print("%s" % schema.get())
 
+def user_key(args):
+    if args['userkey'] is None:
+        print("You must specify the user with -U/--userkey")
+        sys.exit(1)
+
+    return args['userkey']
+
 def user_add(args):
+    import federator
     args = vars(args)
-    user = federator.User(userKey=args['userkey'])
-    added = user.add_role(roleArn=args['rolearn'], providerArn=args['providerarn'])
-    if added:
-        print("Updated user %s" % args['userkey'])
-    else:
-        print("Could not add new role to user %s" % args['userkey'])
-        sys.exit(1)
+    user = federator.User(userKey=user_key(args))
+    if user.add_role(roleArn=args['rolearn'], providerArn=args['providerarn']) is None:
+        print("That user already has access to that role")
+    print("Updated user %s" % args['userkey'])
 
 def user_remove(args):
+    import federator
     args = vars(args)
     print("removing a role from a user: %s" % args)
-    user = federator.User(userKey=args['userkey'])
+    user = federator.User(userKey=user_key(args))
     if args.has_key('customtype') and args['customtype'] is not None:
         removed = user.remove_role(customType=args['customtype'])
     elif (args.has_key('rolearn') and args.has_key('providerarn')):
@@ -78,25 +99,297 @@ def user_remove(args):
         sys.exit(1)
 
 def user_show(args):
+    import federator
     args = vars(args)
-    user = federator.User(userKey=args['userkey'])
+    user = federator.User(userKey=user_key(args))
     print(user.get())
 
 def user_duration(args):
+    import federator
     args = vars(args)
-    user = federator.User(userKey=args['userkey'])
+    user = federator.User(userKey=user_key(args))
     user.set_duration(duration=args['duration'])
 
+def user_edit(args):
+    import federator
+    args = vars(args)
+    user = federator.User(userKey=user_key(args))
+    try:
+        edit = user.edit().options(add=args['add'], remove=args['remove'], duration=args['duration'])
+    except ValueError as err:
+        print(err)
+        sys.exit(1)
+
+    changes = edit.commit()
+    for change in changes:
+        print(change)
+    if not changes:
+        print("No changes to user %s" % args['userkey'])
+
+def journal_input(path):
+    import journal
+    return journal.Journal.file_input(path)
+
+def open_journal(command, job, inputs, args):
+    # The change journal for a multi-user job; see journal.Journal
+    import journal
+    return journal.Journal.for_job(command.store, job, inputs, resume=args['resume'])
+
+def finish(status, journal=None):
+    # Print per-user status and exit non-zero if any failed. The journal is
+    # only thrown away once every user has succeeded.
+    failed = False
+    for userKey in sorted(status):
+        print("%s: %s" % (userKey, status[userKey]))
+        if status[userKey].startswith('error'):
+            failed = True
+
+    if journal is not None:
+        journal.finish(succeeded=not failed)
+        if failed:
+            print("Run again with --resume to retry only the users that did not finish")
+    if failed:
+        sys.exit(1)
+
+def user_bulk(args):
+    import bulk
+    args = vars(args)
+    try:
+        rows = bulk.Bulk.read_manifest(args['manifest'])
+    except (IOError, ValueError) as err:
+        print("Could not read manifest: %s" % err)
+        sys.exit(1)
+
+    bulker = bulk.Bulk(batchSize=args['batchsize'])
+    journal = open_journal(bulker, 'user-bulk', [journal_input(args['manifest'])], args)
+    finish(bulker.apply(rows, journal=journal), journal)
+
+def sync_run(args):
+    import sync
+    args = vars(args)
+    syncer = sync.Sync(customerId=args['customerid'], batchSize=args['batchsize'])
+    try:
+        plan = syncer.plan(sync.Sync.read_desired(args['desired']), syncer.current_state(), prune=args['prune'])
+    except (IOError, ValueError) as err:
+        print("Could not read desired state: %s" % err)
+        sys.exit(1)
+
+    if not plan:
+        print("No changes")
+        return True
+
+    for userKey, changes, patch in plan:
+        print(userKey)
+        for change in changes:
+            print("    %s" % change)
+
+    if args['dry_run']:
+        print("%d user(s) would be updated" % len(plan))
+        return True
+
+    journal = open_journal(syncer, 'sync', [journal_input(args['desired']), args['customerid'], str(args['prune'])], args)
+    finish(syncer.apply(plan, journal=journal), journal)
+
+def report_roles(args):
+    import report
+    args = vars(args)
+    report.Report(customerId=args['customerid']).write(sys.stdout, format=args['format'])
+
+def group_apply(args):
+    import errors, groups
+    args = vars(args)
+    try:
+        mapper = groups.GroupMapping(batchSize=args['batchsize'])
+    except errors.CredentialError as err:
+        print(err)
+        print("Group commands need their own credentials; run 'federator init --groups' first")
+        sys.exit(1)
+    try:
+        rows = mapper.rows(groups.GroupMapping.read_mapping(args['mapping']))
+    except (IOError, ValueError) as err:
+        print("Could not read group mapping: %s" % err)
+        sys.exit(1)
+
+    if args['dry_run']:
+        for row in rows:
+            print("%s: %s" % (row['userKey'], row['roleArn']))
+        print("%d role assignment(s); %d group(s) expanded" % (len(rows), len(mapper.memo)))
+        return True
+
+    journal = open_journal(mapper, 'group-apply', [journal_input(args['mapping'])], args)
+    finish(mapper.apply(rows, journal=journal), journal)
+
+def role_migrate(args):
+    import migrate
+    args = vars(args)
+    try:
+        migration = migrate.Migration(fromArn=args['from'], toArn=args['to'], customerId=args['customerid'])
+    except ValueError as err:
+        print(err)
+        sys.exit(1)
+
+    journal = None
+    if not args['dry_run']:
+        journal = open_journal(migration, 'role-migrate', [args['from'], args['to'], args['customerid']], args)
+    status = migration.run(dryRun=args['dry_run'], journal=journal)
+    if not status:
+        print("No users hold %s" % args['from'])
+    finish(status, journal)
+
+def tenants_run(args):
+    import tenants
+    import json
+    args = vars(args)
+    try:
+        fanout = tenants.Tenants.read_tenants(args['tenants'])
+    except (IOError, ValueError) as err:
+        print("Could not read tenants: %s" % err)
+        sys.exit(1)
+
+    results = fanout.run(args['operation'])
+    if args['json']:
+        print(json.dumps(results, sort_keys=True, indent=4, separators=(',', ': ')))
+    else:
+        for result in results:
+            if result.has_key('error'):
+                status = "error: %s" % result['error']
+            elif args['operation'] == 'create' and result.get('created'):
+                status = "created"
+            else:
+                status = "exists" if result['exists'] else "does not exist"
+            print("%-20s %-20s %s" % (result['customerId'], result['profile'] or '-', status))
+            if args['operation'] == 'show' and result.get('schema'):
+                for field in result['schema'].get('fields', []):
+                    line = "    %-16s %-8s %s" % (field.get('fieldName'), field.get('fieldType'),
+                        "multi-valued" if field.get('multiValued') else "")
+                    print(line.rstrip())
+
+    if not all(result['ok'] for result in results):
+        sys.exit(1)
+
+def role_members(args):
+    import errors, federator, index
+    args = vars(args)
+    # the same index `federator watch` keeps up to date
+    try:
+        store = federator.Federator.credential_store()
+    except errors.CredentialError as err:
+        print(err)
+        sys.exit(1)
+    roles = index.RoleIndex(store)
+    if args['refresh'] or roles.empty():
+        roles.refresh(federator.User(), customer=args['customerid'])
+
+    for userKey in roles.members(args['arn']):
+        print(userKey)
+
+def watch_users(args):
+    import watch
+    args = vars(args)
+    host, _, port = args['listen'].rpartition(':')
+    if args['poll_interval'] is not None:
+        watch.Watcher.pollInterval = args['poll_interval']
+    watcher = watch.Watcher(address=args['address'], customerId=args['customerid'])
+    print("Listening for notifications on %s:%s for %s" % (host or '127.0.0.1', port, args['address']))
+    try:
+        watch.watch(watcher, listen=(host or '127.0.0.1', int(port)))
+    except KeyboardInterrupt:
+        pass
+
+def serve(args):
+    import federator, server
+    args = vars(args)
+    path = os.path.expanduser(args['socket'])
+    print("Serving on %s" % path)
+    server.serve(path, workers=federator.Federator.workers)
+
+# commands that can be sent to `federator serve`, with the arguments they take
+remote_commands = {
+    schema_verify: ('schema_verify', ['customerid']),
+    schema_show: ('schema_show', ['customerid']),
+    user_show: ('user_show', ['userkey']),
+    user_add: ('user_add', ['userkey', 'rolearn', 'providerarn']),
+    user_remove: ('user_remove', ['userkey', 'rolearn', 'providerarn', 'customtype']),
+    user_duration: ('user_duration', ['userkey', 'duration']),
+    user_edit: ('user_edit', ['userkey', 'add', 'remove', 'duration']),
+}
+
+def remote(args):
+    func = args.func
+    args = vars(args)
+    if func not in remote_commands:
+        print("That command can't be sent to a federator server")
+        sys.exit(1)
+
+    op, names = remote_commands[func]
+    if 'userkey' in names:
+        user_key(args)
+
+    try:
+        ok, output = client.Client(args['server']).call(op, **dict((name, args.get(name)) for name in names))
+    except (IOError, ValueError, httplib.HTTPException) as err:
+        print("Could not talk to the federator server at %s: %s" % (args['server'], err))
+        sys.exit(1)
+
+    if output:
+        print(output)
+    if not ok:
+        sys.exit(1)
+
+def configure(args):
+    # global options that tune the library; this is where the Google API
+    # client first gets loaded
+    import federator
+    if args.discovery_ttl is not None:
+        federator.Federator.discoveryTtl = args.discovery_ttl
+    if args.offline:
+        federator.Federator.discoveryOffline = True
+    if args.quota is not None:
+        federator.Federator.quota = args.quota
+    if args.workers is not None:
+        federator.Federator.workers = args.workers
+    if args.profile is not None:
+        federator.Federator.profile = args.profile
+    if args.validate_iam:
+        import errors, iam
+        try:
+            federator.User.arnValidator = iam.IamValidator(store=federator.Federator.credential_store(),
+                    ttl=args.iam_ttl, assumeRole=args.iam_role, endpointUrl=args.iam_endpoint)
+        except (ImportError, errors.CredentialError) as err:
+            print(err)
+            sys.exit(1)
+
 def main():
     parser = argparse.ArgumentParser(prog="federator", description="Manage Google Apps configurations for AWS Single Sign On")
+    parser.add_argument("--discovery-ttl", type=int, help="Seconds to trust the cached API discovery document before revalidating it (default one day)")
+    parser.add_argument("--offline", action="store_true", help="Never fetch the API discovery document; use the cached or bundled copy")
+    parser.add_argument("--quota", type=int, help="API queries per 100 seconds to stay under (default 1500)")
+    parser.add_argument("--workers", type=int, help="Maximum concurrent API requests (default 10)")
+    parser.add_argument("--metrics", metavar="PATH", help="At exit, write API call metrics to PATH (Prometheus textfile format if it ends in .prom, JSON otherwise)")
+    parser.add_argument("--trace", metavar="PATH", help="Append a JSON line for every HTTP request to PATH")
+    parser.add_argument("--profile", help="Use the named set of credentials, e.g. one per customer (create it with 'federator --profile <name> init')")
+    parser.add_argument("--validate-iam", action="store_true", help="Check that role and SAML provider ARNs exist in IAM before using them (needs boto3)")
+    parser.add_argument("--iam-role", metavar="NAME", help="With --validate-iam, assume this role in each account to read IAM (default: use your AWS credentials as they are)")
+    parser.add_argument("--iam-ttl", type=int, help="With --validate-iam, seconds to trust the cached list of an account's roles and providers (default 3600)")
+    parser.add_argument("--iam-endpoint", metavar="URL", help="With --validate-iam, send IAM and STS calls here instead of AWS (e.g. a local moto server)")
+    parser.add_argument("--server", metavar="SOCKET", help="Send the command to the 'federator serve' running on SOCKET")
+    parser.add_argument("--use-server", action="store_true", help="Send the command to the 'federator serve' running on %s" % client.defaultSocket)
     main_subparsers = parser.add_subparsers(help="subcommand help")
 
     parser_init = main_subparsers.add_parser("init", help="Initial setup of Federator")
     parser_schema = main_subparsers.add_parser("schema", help="Operations on custom schema")
     parser_user = main_subparsers.add_parser("user", help="User management")
+    parser_report = main_subparsers.add_parser("report", help="Domain-wide reports")
+    parser_group = main_subparsers.add_parser("group", help="Grant roles by Google Group membership")
+    parser_role = main_subparsers.add_parser("role", help="Operations across everyone holding a role")
+    parser_tenants = main_subparsers.add_parser("tenants", help="Run schema operations across many customers at once")
+    parser_serve = main_subparsers.add_parser("serve", help="Run a long-lived server that keeps credentials and caches warm")
+    parser_watch = main_subparsers.add_parser("watch", help="Keep the local role index up to date from Directory API push notifications")
+    parser_sync = main_subparsers.add_parser("sync", help="Reconcile user roles against a desired-state file")
     
     parser_init.add_argument("-I", "--clientid", required=True)
     parser_init.add_argument("-S", "--clientsecret", required=True)
+    parser_init.add_argument("-G", "--groups", action="store_true", help="Also authorise reading group membership, for 'group apply'")
     parser_init.set_defaults(func=init)
 
     parser_schema.add_argument("-C", "--customerid", required=True)
@@ -114,7 +407,7 @@ def main():
     parser_schema_show = schema_subparser.add_parser("show", help="Print the custom schema")
     parser_schema_show.set_defaults(func=schema_show)
 
-    parser_user.add_argument("-U", "--userkey", required=True)
+    parser_user.add_argument("-U", "--userkey", help="The user to operate on (required for all but bulk)")
     user_subparser = parser_user.add_subparsers(help="User subcommand help")
 
     parser_user_add = user_subparser.add_parser("add", help="Add a role to a user")
@@ -137,10 +430,91 @@ def main():
     parser_user_duration.add_argument("-D", "--duration", help="The duration of a user session in seconds")
     parser_user_duration.set_defaults(func=user_duration)
 
+    parser_user_edit = user_subparser.add_parser("edit", help="Make several changes to a user at once, with a single update")
+    parser_user_edit.add_argument("--add", action="append", metavar="ROLEARN,PROVIDERARN", help="A role to add (may be repeated)")
+    parser_user_edit.add_argument("--remove", action="append", metavar="ROLEARN,PROVIDERARN|CUSTOMTYPE", help="A role to remove (may be repeated)")
+    parser_user_edit.add_argument("--duration", type=int, help="The duration of a user session in seconds")
+    parser_user_edit.set_defaults(func=user_edit)
+
+    parser_user_bulk = user_subparser.add_parser("bulk", help="Add and remove roles for many users from a CSV or JSONL manifest")
+    parser_user_bulk.add_argument("-f", "--manifest", required=True, help="Manifest of userKey,roleArn,providerArn,action rows (.csv with a header row, or .jsonl)")
+    parser_user_bulk.add_argument("-B", "--batchsize", type=int, help="Number of API calls per batch request (default 50)")
+    parser_user_bulk.add_argument("--resume", action="store_true", help="Carry on from a run that failed part-way, skipping the users it finished")
+    parser_user_bulk.set_defaults(func=user_bulk)
+
+    parser_sync.add_argument("-f", "--desired", required=True, help="JSON file mapping users to their roles and session duration")
+    parser_sync.add_argument("-C", "--customerid", default="my_customer", help="The customer ID whose users are reconciled (default: your own domain)")
+    parser_sync.add_argument("-n", "--dry-run", action="store_true", help="Print the plan but do not apply it")
+    parser_sync.add_argument("--prune", action="store_true", help="Remove all roles from users that are not in the desired-state file")
+    parser_sync.add_argument("-B", "--batchsize", type=int, help="Number of API calls per batch request (default 50)")
+    parser_sync.add_argument("--resume", action="store_true", help="Carry on from a run that failed part-way, skipping the users it finished")
+    parser_sync.set_defaults(func=sync_run)
+
+    parser_report.add_argument("-C", "--customerid", default="my_customer", help="The customer ID to report on (default: your own domain)")
+    report_subparser = parser_report.add_subparsers(help="Report subcommand help")
+
+    parser_report_roles = report_subparser.add_parser("roles", help="List every user's AWS roles")
+    parser_report_roles.add_argument("-o", "--format", choices=["jsonl", "csv"], default="jsonl", help="Output format (default jsonl)")
+    parser_report_roles.set_defaults(func=report_roles)
+
+    parser_role.add_argument("-C", "--customerid", default="my_customer", help="The customer ID whose users are indexed (default: your own domain)")
+    role_subparser = parser_role.add_subparsers(help="Role subcommand help")
+
+    parser_role_members = role_subparser.add_parser("members", help="List the users holding a role, trusting a provider, or with roles in an account")
+    parser_role_members.add_argument("arn", help="A role ARN, saml-provider ARN, 12-digit account ID or custom type name")
+    parser_role_members.add_argument("-r", "--refresh", action="store_true", help="Bring the local index up to date before looking up")
+    parser_role_members.set_defaults(func=role_members)
+
+    parser_role_migrate = role_subparser.add_parser("migrate", help="Replace a role or saml-provider ARN for everyone who holds it")
+    parser_role_migrate.add_argument("--from", required=True, help="The role or saml-provider ARN to replace")
+    parser_role_migrate.add_argument("--to", required=True, help="The ARN to replace it with (of the same kind)")
+    parser_role_migrate.add_argument("-n", "--dry-run", action="store_true", help="List the affected users but do not change them")
+    parser_role_migrate.add_argument("--resume", action="store_true", help="Carry on from a run that failed part-way, skipping the users it finished")
+    parser_role_migrate.set_defaults(func=role_migrate)
+
+    group_subparser = parser_group.add_subparsers(help="Group subcommand help")
+    parser_group_apply = group_subparser.add_parser("apply", help="Add the mapped roles to every member of each group")
+    parser_group_apply.add_argument("-f", "--mapping", required=True, help="JSON file mapping group email addresses to role/provider ARN pairs")
+    parser_group_apply.add_argument("-n", "--dry-run", action="store_true", help="Print the role assignments but do not apply them")
+    parser_group_apply.add_argument("-B", "--batchsize", type=int, help="Number of API calls per batch request (default 50)")
+    parser_group_apply.add_argument("--resume", action="store_true", help="Carry on from a run that failed part-way, skipping the users it finished")
+    parser_group_apply.set_defaults(func=group_apply)
+
+    parser_tenants.add_argument("-f", "--tenants", required=True, help="JSON list of {\"customerId\": ..., \"profile\": ...} objects")
+    parser_tenants.add_argument("operation", choices=["verify", "create", "show"], help="What to do with the custom schema for each customer")
+    parser_tenants.add_argument("--json", action="store_true", help="Print the aggregated report as JSON")
+    parser_tenants.set_defaults(func=tenants_run)
+
+    parser_serve.add_argument("-s", "--socket", default=client.defaultSocket, help="The Unix socket to listen on (default %s)" % client.defaultSocket)
+    parser_serve.set_defaults(func=serve)
+
+    parser_watch.add_argument("-a", "--address", required=True, help="The public HTTPS URL Google should send notifications to; it must reach --listen")
+    parser_watch.add_argument("-l", "--listen", default="127.0.0.1:8088", help="The HOST:PORT to receive notifications on (default 127.0.0.1:8088)")
+    parser_watch.add_argument("-C", "--customerid", default="my_customer", help="The customer ID whose users are watched (default: your own domain)")
+    parser_watch.add_argument("--poll-interval", type=int, help="Seconds between polls of the directory while push notifications aren't working (default 300)")
+    parser_watch.set_defaults(func=watch_users)
+
     args = parser.parse_args()
-    # have to clean out our command-line args or they get swallowed twice during init
-    sys.argv = ['']
-    args.func(args)
+    if args.metrics:
+        atexit.register(metrics.registry.write, args.metrics)
+    if args.trace:
+        metrics.registry.start_trace(args.trace)
+    if args.use_server and not args.server:
+        args.server = client.defaultSocket
+    if args.server:
+        remote(args)
+        return
+
+    import errors
+    try:
+        configure(args)
+
+        # have to clean out our command-line args or they get swallowed twice during init
+        sys.argv = ['']
+        args.func(args)
+    except errors.FederatorError as err:
+        print(err)
+        sys.exit(1)
 
 if __name__ == "__main__":
     main()
@@ -0,0 +1,143 @@
+#!/usr/bin/env python
+
+from concurrent.futures import ThreadPoolExecutor
+import copy
+import errors
+from googleapiclient.errors import HttpError
+from federator import User, Schema
+
+# A library API for programs that embed Federator, e.g. a web application
+# handling many access requests at once. Every operation returns a
+# concurrent.futures.Future (from the futures backport on Python 2) at once
+# and runs on a fixed pool of `concurrency` threads sharing one set of
+# credentials and one API service, so at most that many calls are in flight.
+# Failures are raised from Future.result() as errors.FederatorError
+# subclasses; nothing is printed and the process never exits.
+#
+#   with api.Api(concurrency=20) as federation:
+#       futures = [federation.add_role(userKey, roleArn, providerArn) for userKey in userKeys]
+#       results = api.gather(*futures, return_exceptions=True)
+
+def gather(*futures, **kwargs):
+    # The results of all the futures, in order. Raises the first failure
+    # unless return_exceptions=True, in which case it's returned in its place.
+    returnExceptions = kwargs.get('return_exceptions', False)
+    results = []
+    for future in futures:
+        error = future.exception()
+        if error is not None and not returnExceptions:
+            raise error
+        results.append(error if error is not None else future.result())
+    return results
+
+def translate(err, thing):
+    # A typed exception for an error from the Directory API
+    status = int(err.resp.status)
+    if status == 404:
+        if isinstance(thing, Schema):
+            return errors.SchemaNotFound("No AWS-SSO schema for customer %s" % thing.customerId)
+        return errors.UserNotFound("No such user %s" % thing.userKey)
+    if status == 403:
+        return errors.PermissionDenied("Not allowed: %s" % err)
+    return errors.ApiError("Google API error: %s" % err, status=status)
+
+class Api(object):
+    concurrency = 10
+
+    def __init__(self, profile=None, concurrency=None, clientId=None, clientSecret=None):
+        if concurrency is not None:
+            self.concurrency = concurrency
+
+        # made now, so credential problems are raised here rather than from
+        # every call; each call works on a shallow copy
+        self.users = User(clientId=clientId, clientSecret=clientSecret, profile=profile)
+        self.schemas = Schema(clientId=clientId, clientSecret=clientSecret, profile=profile)
+
+        self.pool = ThreadPoolExecutor(max_workers=self.concurrency)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, type, value, traceback):
+        self.close()
+
+    def close(self):
+        # Finish what's queued, then stop the threads
+        self.pool.shutdown(wait=True)
+
+    @staticmethod
+    def call(func, thing):
+        try:
+            return func(thing)
+        except HttpError as err:
+            raise translate(err, thing)
+        except errors.FederatorError:
+            raise
+        except Exception as err:
+            raise errors.FederatorError("%s: %s" % (type(err).__name__, err))
+
+    def submit(self, func, thing):
+        return self.pool.submit(self.call, func, thing)
+
+    def user(self, userKey):
+        user = copy.copy(self.users)
+        user.userKey = userKey
+        return user
+
+    def schema(self, customerId):
+        schema = copy.copy(self.schemas)
+        schema.customerId = customerId
+        return schema
+
+    def get_user(self, userKey):
+        # The whole user, as the Directory API returns it
+        return self.submit(lambda user: user.fetch(), self.user(userKey))
+
+    def get_roles(self, userKey):
+        # The user's AWS-SSO block
+        return self.submit(lambda user: user.get_current(), self.user(userKey))
+
+    def edit(self, userKey, add=None, remove=None, duration=None):
+        # Several changes in one update; see federator.Edit.options. The
+        # result is the list of changes made.
+        def call(user):
+            return user.edit().options(add=add, remove=remove, duration=duration).commit()
+        return self.submit(call, self.user(userKey))
+
+    def add_role(self, userKey, roleArn, providerArn):
+        # True if the role was added, False if the user already had it
+        def call(user):
+            return bool(user.edit().add(roleArn, providerArn).commit())
+        return self.submit(call, self.user(userKey))
+
+    def remove_role(self, userKey, roleArn=None, providerArn=None, customType=None):
+        # True if the role was removed, False if the user didn't have it
+        def call(user):
+            return bool(user.edit().remove(roleArn=roleArn, providerArn=providerArn, customType=customType).commit())
+        return self.submit(call, self.user(userKey))
+
+    def set_duration(self, userKey, duration):
+        # True if the duration changed
+        def call(user):
+            return bool(user.edit().duration(duration).commit())
+        return self.submit(call, self.user(userKey))
+
+    def get_schema(self, customerId='my_customer'):
+        # The AWS-SSO schema; raises SchemaNotFound if there isn't one
+        def call(schema):
+            found = schema.fetch()
+            if found is None:
+                raise errors.SchemaNotFound("No AWS-SSO schema for customer %s" % schema.customerId)
+            return found
+        return self.submit(call, self.schema(customerId))
+
+    def schema_exists(self, customerId='my_customer'):
+        return self.submit(lambda schema: schema.exists(), self.schema(customerId))
+
+    def create_schema(self, customerId='my_customer'):
+        # True if the schema was created, False if it already existed
+        def call(schema):
+            if schema.exists():
+                return False
+            return schema.create()
+        return self.submit(call, self.schema(customerId))
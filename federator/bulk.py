@@ -0,0 +1,234 @@
+#!/usr/bin/env python
+
+import csv
+import errors
+import json
+from googleapiclient.errors import HttpError
+from federator import User
+
+class Bulk(User):
+    # Apply many role changes at once. Rows look like
+    #   {'userKey': ..., 'roleArn': ..., 'providerArn': ..., 'action': 'add'|'remove'}
+    # Every affected user is read once, all of that user's rows are merged
+    # with the same logic as User.add_role/remove_role, and at most one patch
+    # is sent per user. Reads and patches go out as batch HTTP requests.
+
+    manifestFields = ['userKey', 'roleArn', 'providerArn', 'action']
+    actions = ['add', 'remove']
+
+    # The Admin SDK accepts up to 1000 calls per batch, but large batches
+    # are more likely to trip the per-user rate limits
+    batchSize = 50
+
+    def __init__(self, clientId=None, clientSecret=None, batchSize=None):
+        super(Bulk, self).__init__(userKey=None, clientId=clientId, clientSecret=clientSecret)
+        if batchSize is not None:
+            self.batchSize = batchSize
+
+    @classmethod
+    def read_manifest(cls, path):
+        # JSONL if the file says so, CSV (with a header row) otherwise
+        rows = []
+        if path.endswith('.jsonl') or path.endswith('.json'):
+            with open(path) as manifest:
+                for line in manifest:
+                    line = line.strip()
+                    if line:
+                        rows.append(json.loads(line))
+        else:
+            with open(path, 'rb') as manifest:
+                for row in csv.DictReader(manifest):
+                    rows.append(row)
+
+        for row in rows:
+            for field in cls.manifestFields:
+                if not row.get(field):
+                    raise ValueError("Manifest row %s is missing '%s'" % (row, field))
+            row['action'] = row['action'].strip().lower()
+            if row['action'] not in cls.actions:
+                raise ValueError("Manifest row %s has an unknown action; must be one of %s" % (row, cls.actions))
+
+        return rows
+
+    def execute_batch(self, requests):
+        # Run (key, request) pairs as batch HTTP requests, batchSize at a time.
+        # Returns {key: (response, exception)}
+        return self.executor().batch(self.service.new_batch_http_request, requests, self.batchSize)
+
+    def get_many(self, userKeys):
+        # building the users resource walks the discovery document, so it's
+        # done once rather than for every request
+        users = self.service.users()
+        requests = []
+        for userKey in userKeys:
+            requests.append((userKey, users.get(userKey=userKey,
+                projection='custom', customFieldMask='AWS-SSO')))
+
+        return self.execute_batch(requests)
+
+    def patch_many(self, patches, etags=None):
+        # A patch for a user in etags ({userKey: etag}) is only applied if
+        # the user still has that etag
+        users = self.service.users()
+        requests = []
+        for userKey, patch in patches:
+            request = users.patch(userKey=userKey, body=patch)
+            if etags and etags.get(userKey):
+                request.headers['If-Match'] = etags[userKey]
+            requests.append((userKey, request))
+
+        return self.execute_batch(requests)
+
+    def send(self, patches, etags, replan, journal=None):
+        # Send (userKey, patch) pairs conditionally, as User.update does.
+        # Users that someone else changed after we read them (412) are read
+        # again, replan(userKey, user) works out their patch afresh (None if
+        # there's nothing left to do) and they go again, up to
+        # conflictRetries times. Returns {userKey: status}.
+        status = {}
+        for attempt in range(self.conflictRetries + 1):
+            if journal is not None:
+                for userKey, patch in patches:
+                    journal.plan(userKey, etags.get(userKey), patch)
+
+            conflicts = []
+            for userKey, (response, exception) in self.patch_many(patches, etags).items():
+                if exception is None:
+                    status[userKey] = 'updated'
+                    if journal is not None:
+                        journal.complete(userKey)
+                elif isinstance(exception, HttpError) and int(exception.resp.status) == 412:
+                    conflicts.append(userKey)
+                else:
+                    status[userKey] = "error: %s" % exception
+
+            patches = []
+            if not conflicts:
+                break
+            for userKey, (response, exception) in self.get_many(conflicts).items():
+                if exception is not None:
+                    status[userKey] = "error: %s" % exception
+                    continue
+                etags[userKey] = response.get('etag')
+                patch = replan(userKey, response)
+                if patch is not None:
+                    patches.append((userKey, patch))
+                    continue
+                status[userKey] = 'unchanged'
+                if journal is not None:
+                    journal.complete(userKey, status='unchanged')
+
+        for userKey, patch in patches:
+            status[userKey] = "error: kept changing underneath us; gave up after %d attempts" % (self.conflictRetries + 1)
+
+        return status
+
+    def plan(self, rows, users):
+        # Work out the patch for each user from their current state. Returns
+        # a list of (userKey, patch) and a dict of {userKey: status}
+        status = {}
+        original = {}
+        pending = {}
+        order = []
+        for row in rows:
+            userKey = row['userKey']
+            if status.has_key(userKey) and status[userKey] not in ('updated', 'unchanged'):
+                continue
+
+            if not pending.has_key(userKey):
+                response, exception = users[userKey]
+                if exception is not None:
+                    status[userKey] = "error: %s" % exception
+                    continue
+                original[userKey] = self.sso_from(response)
+                pending[userKey] = {'customSchemas': {'AWS-SSO': self.sso_from(response)}}
+                status[userKey] = 'unchanged'
+                order.append(userKey)
+
+            current = pending[userKey]['customSchemas']['AWS-SSO']
+            if row['action'] == 'add':
+                try:
+                    self.match_arns(row['roleArn'], row['providerArn'])
+                except errors.InvalidArn as err:
+                    status[userKey] = "error: invalid ARN in %s: %s" % (row, err)
+                    continue
+                patch = self.add_role_patch(current, row['roleArn'], row['providerArn'])
+            else:
+                patch, removed = self.remove_role_patch(current,
+                        roleArn=row['roleArn'], providerArn=row['providerArn'])
+                if not removed:
+                    patch = None
+
+            if patch is not None:
+                pending[userKey] = patch
+                status[userKey] = 'updated'
+
+        patches = []
+        for userKey in order:
+            if status[userKey] != 'updated':
+                continue
+            # rows that cancel out (e.g. add then remove the same role) leave
+            # nothing to send
+            if pending[userKey]['customSchemas']['AWS-SSO'] == original[userKey]:
+                status[userKey] = 'unchanged'
+                continue
+            patches.append((userKey, pending[userKey]))
+
+        return patches, status
+
+    def apply(self, rows, journal=None):
+        # With a journal, users it says are done are skipped, and each patch
+        # is recorded before it's sent and once it has succeeded. Users whose
+        # patch was in flight aren't read again: the journaled patch is sent
+        # as it was, conditional on the journaled etag. If it did land, or
+        # someone else has changed the user since, that fails with a 412 and
+        # the user is re-read and re-planned, so a patch that landed is seen
+        # as 'unchanged'.
+        # userKeys keeps the manifest's order; wanted is for membership tests
+        userKeys = []
+        wanted = set()
+        status = {}
+        for row in rows:
+            if row['userKey'] in wanted or status.has_key(row['userKey']):
+                continue
+            if journal is not None and journal.is_done(row['userKey']):
+                status[row['userKey']] = 'done'
+                continue
+            wanted.add(row['userKey'])
+            userKeys.append(row['userKey'])
+
+        inFlight = {}
+        if journal is not None:
+            for userKey in journal.in_flight():
+                if userKey in wanted and journal.planned[userKey].get('etag'):
+                    inFlight[userKey] = journal.planned[userKey]
+
+        rows = [row for row in rows if row['userKey'] in wanted]
+        users = self.get_many([userKey for userKey in userKeys if not inFlight.has_key(userKey)])
+        patches, planned = self.plan([row for row in rows if not inFlight.has_key(row['userKey'])], users)
+        status.update(planned)
+
+        if journal is not None:
+            for userKey in planned:
+                if status[userKey] == 'unchanged':
+                    journal.complete(userKey, status='unchanged')
+
+        etags = dict((userKey, users[userKey][0].get('etag')) for userKey, patch in patches)
+        for userKey in userKeys:
+            if inFlight.has_key(userKey):
+                patches.append((userKey, inFlight[userKey]['patch']))
+                etags[userKey] = inFlight[userKey]['etag']
+
+        status.update(self.send(patches, etags, self.replanner(rows), journal=journal))
+        return status
+
+    def replanner(self, rows):
+        # For send(): the patch for one user's rows against a fresh read
+        byUser = {}
+        for row in rows:
+            byUser.setdefault(row['userKey'], []).append(row)
+
+        def replan(userKey, user):
+            patches, status = self.plan(byUser[userKey], {userKey: (user, None)})
+            return patches[0][1] if patches else None
+        return replan
@@ -0,0 +1,80 @@
+#!/usr/bin/env python
+
+import copy
+import errno
+import json
+import os
+import tempfile
+import threading
+from Crypto.Hash import SHA256
+
+def atomic_write(path, data, mode=None):
+    # Write-then-rename, so a concurrent reader never sees half a file. The
+    # temporary file is unique to this call (not just this process), so
+    # threads writing the same path don't rename each other's files away.
+    # It is created mode 0600; pass mode for files other users must read.
+    fd, tmp = tempfile.mkstemp(dir=os.path.dirname(path), prefix=os.path.basename(path) + '.')
+    try:
+        if mode is not None:
+            os.fchmod(fd, mode)
+        with os.fdopen(fd, 'w') as out:
+            out.write(data)
+        os.rename(tmp, path)
+    except:
+        os.unlink(tmp)
+        raise
+
+class UserCache(object):
+    # The last version of each user we read, with its etag, kept under
+    # ~/.federator/users so that later reads (even from another run) can be
+    # conditional. Files are named by the SHA256 of the user key.
+    # Copies of a User (see api.Api and migrate) share one cache between
+    # threads, so the memory dict and the files are only changed under lock.
+
+    def __init__(self, store):
+        self.path = os.path.join(store, 'users')
+        self.memory = {}
+        self.lock = threading.Lock()
+        try:
+            os.mkdir(self.path, 0700)
+        except OSError as err:
+            if err.errno != errno.EEXIST:
+                raise
+
+    def filename(self, userKey):
+        key_hash = SHA256.new()
+        # keys read back from the API are unicode, which the hash won't take
+        if isinstance(userKey, unicode):
+            userKey = userKey.encode('utf-8')
+        key_hash.update(userKey.lower())
+        return os.path.join(self.path, key_hash.hexdigest())
+
+    def get(self, userKey):
+        # Returns a copy, so callers are free to modify it. Entries are only
+        # ever replaced, never changed in place, so the copy needs no lock.
+        with self.lock:
+            entry = self.memory.get(userKey)
+            if entry is None:
+                try:
+                    with open(self.filename(userKey)) as cached:
+                        entry = json.load(cached)
+                except (IOError, ValueError):
+                    return None
+                self.memory[userKey] = entry
+
+        return copy.deepcopy(entry)
+
+    def put(self, userKey, user):
+        entry = copy.deepcopy(user)
+        with self.lock:
+            self.memory[userKey] = entry
+            atomic_write(self.filename(userKey), json.dumps(user))
+
+    def invalidate(self, userKey):
+        with self.lock:
+            self.memory.pop(userKey, None)
+            try:
+                os.unlink(self.filename(userKey))
+            except OSError as err:
+                if err.errno != errno.ENOENT:
+                    raise
@@ -0,0 +1,52 @@
+#!/usr/bin/env python
+
+import errno
+import httplib
+import json
+import os
+import socket
+import time
+
+# Talks to a `federator serve` daemon over its Unix socket. Only uses the
+# standard library, so the CLI doesn't have to load the Google API client.
+
+defaultSocket = '~/.federator/federator.sock'
+
+class UnixHTTPConnection(httplib.HTTPConnection):
+    # how many times to try connecting while the server's backlog is full
+    connectAttempts = 10
+    connectBackoff = 0.05
+
+    def __init__(self, path, timeout=300):
+        httplib.HTTPConnection.__init__(self, 'localhost', timeout=timeout)
+        self.path = path
+
+    def connect(self):
+        # With a timeout set, the socket is non-blocking, so a full listen
+        # backlog fails the connect at once rather than waiting
+        for attempt in range(self.connectAttempts):
+            self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            self.sock.settimeout(self.timeout)
+            try:
+                self.sock.connect(self.path)
+                return
+            except socket.error as err:
+                self.sock.close()
+                if err.errno not in (errno.EAGAIN, errno.ECONNREFUSED) or attempt == self.connectAttempts - 1:
+                    raise
+            time.sleep(self.connectBackoff * (2 ** attempt))
+
+class Client(object):
+    def __init__(self, path=None):
+        self.path = os.path.expanduser(path or defaultSocket)
+
+    def call(self, op, **args):
+        # Returns (ok, output)
+        connection = UnixHTTPConnection(self.path)
+        try:
+            connection.request('POST', '/' + op, json.dumps(args), {'Content-Type': 'application/json'})
+            response = json.loads(connection.getresponse().read())
+        finally:
+            connection.close()
+
+        return response['ok'], response['output']
@@ -0,0 +1,150 @@
+#!/usr/bin/env python
+
+from array import array
+import bisect
+
+class Interner(object):
+    # Hands out a small integer for each distinct value, so that an ARN that
+    # a hundred thousand users share is only held in memory once
+
+    def __init__(self):
+        self.ids = {}
+        self.values = []
+
+    def __len__(self):
+        return len(self.values)
+
+    def id(self, value):
+        try:
+            return self.ids[value]
+        except KeyError:
+            self.ids[value] = len(self.values)
+            self.values.append(value)
+            return self.ids[value]
+
+    def value(self, id):
+        return self.values[id]
+
+class Snapshot(object):
+    # The AWS-SSO blocks of a whole directory, held compactly: each distinct
+    # (role value, customType) is interned once, and each user is a key, a
+    # duration and a run of sorted role IDs in shared arrays. Users are kept
+    # sorted by key, so two snapshots that share an Interner can be diffed
+    # in a single merge pass without building a dict per user.
+
+    noDuration = -1
+
+    def __init__(self, roles=None):
+        self.roles = roles if roles is not None else Interner()
+        self.userKeys = []
+        self.etags = []
+        self.durations = array('i')
+        # user i's role IDs are assignments[offsets[i]:offsets[i + 1]]
+        self.offsets = array('i', [0])
+        self.assignments = array('i')
+        self.ordered = True
+
+    def __len__(self):
+        return len(self.userKeys)
+
+    def add(self, userKey, block, etag=None):
+        ids = set()
+        for role in block.get('role', []):
+            ids.add(self.roles.id((role['value'], role.get('customType'))))
+
+        if self.userKeys and userKey <= self.userKeys[-1]:
+            self.ordered = False
+        self.userKeys.append(userKey)
+        self.etags.append(etag)
+        self.durations.append(int(block['duration']) if block.get('duration') is not None else self.noDuration)
+        self.assignments.extend(sorted(ids))
+        self.offsets.append(len(self.assignments))
+
+    def freeze(self):
+        # Sort by user key once everything has been added. Where a key was
+        # added more than once, the last one wins.
+        if self.ordered:
+            return self
+
+        order = sorted(range(len(self.userKeys)), key=self.userKeys.__getitem__)
+        userKeys, etags = [], []
+        durations, offsets, assignments = array('i'), array('i', [0]), array('i')
+        for n, i in enumerate(order):
+            if n + 1 < len(order) and self.userKeys[order[n + 1]] == self.userKeys[i]:
+                continue
+            userKeys.append(self.userKeys[i])
+            etags.append(self.etags[i])
+            durations.append(self.durations[i])
+            assignments.extend(self.role_ids(i))
+            offsets.append(len(assignments))
+
+        self.userKeys, self.etags = userKeys, etags
+        self.durations, self.offsets, self.assignments = durations, offsets, assignments
+        self.ordered = True
+        return self
+
+    def index(self, userKey):
+        # The position of a user, or None
+        i = bisect.bisect_left(self.userKeys, userKey)
+        if i < len(self.userKeys) and self.userKeys[i] == userKey:
+            return i
+        return None
+
+    def role_ids(self, i):
+        return self.assignments[self.offsets[i]:self.offsets[i + 1]]
+
+    def duration(self, i):
+        # None if the user has no duration set
+        if i is None or self.durations[i] == self.noDuration:
+            return None
+        return self.durations[i]
+
+    def block(self, i):
+        # User i's AWS-SSO block, as the API would have it
+        block = {'role': [{'value': value, 'customType': customType}
+                          for value, customType in (self.roles.value(id) for id in self.role_ids(i))]}
+        if self.durations[i] != self.noDuration:
+            block['duration'] = self.durations[i]
+        return block
+
+    @staticmethod
+    def merge(have, want):
+        # (added, removed) between two sorted runs of IDs
+        added, removed = [], []
+        i = j = 0
+        while i < len(have) or j < len(want):
+            if j == len(want) or (i < len(have) and have[i] < want[j]):
+                removed.append(have[i])
+                i += 1
+            elif i == len(have) or want[j] < have[i]:
+                added.append(want[j])
+                j += 1
+            else:
+                i += 1
+                j += 1
+        return added, removed
+
+    def diff(self, desired, prune=False):
+        # Walk this (current) snapshot and a desired one together, yielding
+        # (userKey, i, j, added, removed) for every user in desired and, if
+        # prune is set, every user here with roles that isn't. i and j are
+        # the user's positions here and in desired, or None; added and
+        # removed are role IDs. Both snapshots must share an Interner.
+        assert self.roles is desired.roles
+        self.freeze()
+        desired.freeze()
+
+        i = j = 0
+        while i < len(self) or j < len(desired):
+            if j == len(desired) or (i < len(self) and self.userKeys[i] < desired.userKeys[j]):
+                if prune and self.offsets[i + 1] > self.offsets[i]:
+                    yield self.userKeys[i], i, None, [], list(self.role_ids(i))
+                i += 1
+            elif i == len(self) or desired.userKeys[j] < self.userKeys[i]:
+                yield desired.userKeys[j], None, j, list(desired.role_ids(j)), []
+                j += 1
+            else:
+                added, removed = self.merge(self.role_ids(i), desired.role_ids(j))
+                yield self.userKeys[i], i, j, added, removed
+                i += 1
+                j += 1
@@ -0,0 +1,119 @@
+#!/usr/bin/env python
+
+import datetime
+import fcntl
+import httplib2
+import metrics
+import os
+import threading
+import time
+from oauth2client.file import Storage
+
+class LockedStorage(Storage):
+    # oauth2client's file Storage only locks against other threads. Also take
+    # an advisory lock on a sibling .lock file, so that parallel federator
+    # processes don't all refresh the token at once or rewrite the file under
+    # each other. oauth2client re-reads the file while holding the lock before
+    # refreshing, so a process that waited picks up the token another one just
+    # wrote instead of refreshing again.
+
+    def __init__(self, filename):
+        Storage.__init__(self, filename)
+        self.lockfile = filename + '.lock'
+        self.lockfd = None
+
+    def acquire_lock(self):
+        Storage.acquire_lock(self)
+        try:
+            self.lockfd = os.open(self.lockfile, os.O_RDWR | os.O_CREAT, 0600)
+            fcntl.flock(self.lockfd, fcntl.LOCK_EX)
+        except:
+            Storage.release_lock(self)
+            raise
+
+    def release_lock(self):
+        try:
+            if self.lockfd is not None:
+                fcntl.flock(self.lockfd, fcntl.LOCK_UN)
+                os.close(self.lockfd)
+                self.lockfd = None
+        finally:
+            Storage.release_lock(self)
+
+class CredentialManager(object):
+    # One per credentials file per process. Every Federator object using that
+    # file shares the same in-memory credentials, and a background thread
+    # refreshes the access token a little before it expires, so callers
+    # don't stall on a refresh in the middle of their work.
+
+    refreshMargin = 300
+    retryInterval = 60
+
+    managers = {}
+    managersLock = threading.Lock()
+
+    @classmethod
+    def for_file(cls, credfile):
+        with cls.managersLock:
+            if not cls.managers.has_key(credfile):
+                cls.managers[credfile] = cls(credfile)
+            return cls.managers[credfile]
+
+    def __init__(self, credfile):
+        self.storage = LockedStorage(credfile)
+        self.credentials = None
+        self.lock = threading.Lock()
+        self.refresher = None
+
+    def get(self):
+        # Returns the credentials, or None if there are no valid ones stored
+        with self.lock:
+            if self.credentials is None or self.credentials.invalid:
+                credentials = self.storage.get()
+                if credentials is None or credentials.invalid:
+                    return None
+                self.use(credentials)
+
+            return self.credentials
+
+    def set(self, credentials):
+        # After a fresh OAuth flow (which has already stored them)
+        with self.lock:
+            self.use(credentials)
+
+    def use(self, credentials):
+        credentials.set_store(self.storage)
+        self.credentials = credentials
+        if self.refresher is None:
+            self.refresher = threading.Thread(target=self.refresh_loop)
+            self.refresher.daemon = True
+            self.refresher.start()
+
+    def seconds_left(self):
+        expiry = self.credentials.token_expiry
+        if expiry is None:
+            return None
+        return (expiry - datetime.datetime.utcnow()).total_seconds()
+
+    def refresh_loop(self):
+        while True:
+            left = self.seconds_left()
+            if left is None:
+                # nothing to go on until the token is first used
+                wait = self.retryInterval
+            else:
+                wait = left - self.refreshMargin
+
+            if wait > 0:
+                time.sleep(wait)
+                continue
+
+            try:
+                # counted like any other token refresh
+                self.credentials.refresh(metrics.instrument(httplib2.Http(), metrics.registry))
+            except Exception:
+                # the next request will try again itself; so will we, later
+                pass
+
+            # don't spin if the refresh failed or the new token is short-lived
+            time.sleep(self.retryInterval)
@@ -0,0 +1,117 @@
+#!/usr/bin/env python
+
+from apiclient.discovery import build_from_document
+import cache
+import httplib2
+import json
+import os
+import threading
+import time
+
+# Keep a copy of the Directory API discovery document under ~/.federator, so
+# that building a service doesn't have to download and parse it every time.
+# A cached copy is used as-is for `ttl` seconds; after that it's revalidated
+# with its etag, which is usually a cheap 304.
+
+api = 'admin'
+version = 'directory_v1'
+discoveryUrl = 'https://www.googleapis.com/discovery/v1/apis/%s/%s/rest' % (api, version)
+
+staticDocument = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+        'documents', '%s.%s.json' % (api, version))
+
+# The document as last loaded by this process, shared by every profile's
+# service, so that building many at once (e.g. one per tenant) loads it once
+loaded = {}
+loadLock = threading.Lock()
+
+def cache_paths(store):
+    base = os.path.join(store, 'discovery-%s-%s' % (api, version))
+    return base + '.json', base + '.meta'
+
+def read_cache(store):
+    docfile, metafile = cache_paths(store)
+    try:
+        with open(docfile) as doc:
+            content = doc.read()
+        with open(metafile) as metadata:
+            meta = json.load(metadata)
+    except (IOError, ValueError):
+        return None, None
+
+    return content, meta
+
+def write_cache(store, content, etag):
+    docfile, metafile = cache_paths(store)
+    cache.atomic_write(docfile, content)
+    cache.atomic_write(metafile, json.dumps({'fetched': time.time(), 'etag': etag}))
+
+def static_document():
+    # A copy of the discovery document ships with Federator, for when there's
+    # no cached one and the network can't (or mustn't) be used. Newer client
+    # libraries bundle their own, which are preferred when present.
+    try:
+        from googleapiclient.discovery_cache import get_static_doc
+        content = get_static_doc(api, version)
+    except ImportError:
+        content = None
+
+    if content is None:
+        with open(staticDocument) as doc:
+            content = doc.read()
+
+    return content
+
+def document(store, ttl=86400, offline=False):
+    content, meta = read_cache(store)
+
+    if offline:
+        if content is not None:
+            return content
+        return static_document()
+
+    if content is not None and time.time() - meta.get('fetched', 0) < ttl:
+        return content
+
+    headers = {}
+    if content is not None and meta.get('etag'):
+        headers['if-none-match'] = meta['etag']
+
+    try:
+        resp, body = httplib2.Http().request(discoveryUrl, headers=headers)
+    except (httplib2.HttpLib2Error, IOError):
+        # can't reach the network; a stale copy is better than nothing
+        if content is not None:
+            return content
+        return static_document()
+
+    if resp.status == 304 and content is not None:
+        write_cache(store, content, meta.get('etag'))
+        return content
+
+    if resp.status != 200:
+        if content is not None:
+            return content
+        raise Exception("Could not fetch discovery document: HTTP %s" % resp.status)
+
+    write_cache(store, body, resp.get('etag'))
+    return body
+
+def shared_document(store, ttl=86400, offline=False):
+    with loadLock:
+        if loaded and time.time() - loaded['time'] < ttl:
+            return loaded['content']
+        content = document(store, ttl=ttl, offline=offline)
+        loaded.update({'time': time.time(), 'content': content})
+        return content
+
+def build_service(http, store, ttl=86400, offline=False, rootUrl=None):
+    content = shared_document(store, ttl=ttl, offline=offline)
+    if rootUrl is not None:
+        # point the service somewhere other than www.googleapis.com
+        doc = json.loads(content)
+        doc['rootUrl'] = rootUrl
+        doc['baseUrl'] = rootUrl + doc['servicePath']
+        content = json.dumps(doc)
+
+    return build_from_document(content, http=http)
@@ -0,0 +1,41 @@
+#!/usr/bin/env python
+
+# Exceptions raised by the library instead of printing and exiting, so that
+# Federator can be embedded in other programs. The CLI prints the message and
+# exits non-zero for any FederatorError.
+
+class FederatorError(Exception):
+    pass
+
+class CredentialError(FederatorError):
+    # The credential store or file is missing, unsafe or unusable
+    pass
+
+class InvalidRequest(FederatorError, ValueError):
+    # The arguments don't make sense; nothing was sent to Google
+    pass
+
+class InvalidArn(InvalidRequest):
+    pass
+
+class NotFound(FederatorError):
+    pass
+
+class UserNotFound(NotFound):
+    pass
+
+class SchemaNotFound(NotFound):
+    pass
+
+class PermissionDenied(FederatorError):
+    pass
+
+class ConflictError(FederatorError):
+    # The user kept changing between our read and our write
+    pass
+
+class ApiError(FederatorError):
+    # Any other error from the Directory API; status is the HTTP status
+    def __init__(self, message, status=None):
+        super(ApiError, self).__init__(message)
+        self.status = status
@@ -0,0 +1,220 @@
+#!/usr/bin/env python
+
+from googleapiclient.errors import HttpError
+import functools
+import httplib2
+import json
+import metrics
+import Queue
+import random
+import socket
+import threading
+import time
+
+# Every Directory API call that Federator makes goes through an Executor. It
+# keeps the process under the Admin SDK quota with a token bucket, retries
+# rate-limit and server errors with jittered exponential backoff, and can run
+# many requests at once on a bounded pool of worker threads.
+
+class TokenBucket(object):
+    def __init__(self, rate, capacity):
+        # rate is in tokens per second
+        self.rate = float(rate)
+        self.capacity = float(capacity)
+        self.tokens = self.capacity
+        self.stamp = time.time()
+        self.lock = threading.Lock()
+
+    def take(self, count=1):
+        # Reserve the tokens straight away (going into debt if need be) and
+        # then sleep off the debt outside the lock, so callers queue fairly
+        with self.lock:
+            now = time.time()
+            self.tokens = min(self.capacity, self.tokens + (now - self.stamp) * self.rate)
+            self.stamp = now
+            self.tokens -= count
+            wait = -self.tokens / self.rate if self.tokens < 0 else 0
+
+        if wait > 0:
+            time.sleep(wait)
+
+class Executor(object):
+    retryableReasons = ['rateLimitExceeded', 'userRateLimitExceeded', 'backendError']
+
+    def __init__(self, quota=1500, workers=10, retries=6, backoffBase=1.0, backoffCap=64.0):
+        # quota is in queries per 100 seconds, the unit the Admin SDK uses
+        rate = quota / 100.0
+        self.bucket = TokenBucket(rate, max(1.0, rate))
+        self.workers = workers
+        self.retries = retries
+        self.backoffBase = backoffBase
+        self.backoffCap = backoffCap
+
+    @classmethod
+    def retryable(cls, err):
+        if isinstance(err, (socket.error, httplib2.HttpLib2Error)):
+            return True
+
+        if not isinstance(err, HttpError):
+            return False
+
+        status = int(err.resp.status)
+        if status == 429 or status >= 500:
+            return True
+
+        if status == 403:
+            try:
+                errors = json.loads(err.content)['error']['errors']
+            except (ValueError, KeyError, TypeError):
+                return False
+            for error in errors:
+                if error.get('reason') in cls.retryableReasons:
+                    return True
+
+        return False
+
+    def backoff(self, attempt):
+        # "full jitter": anywhere between zero and the exponential ceiling
+        return random.uniform(0, min(self.backoffCap, self.backoffBase * (2 ** attempt)))
+
+    def execute(self, request, http=None):
+        method = getattr(request, 'methodId', None) or 'unknown'
+        start = time.time()
+        attempt = 0
+        while True:
+            self.bucket.take()
+            try:
+                if http is None:
+                    response = request.execute()
+                else:
+                    response = request.execute(http=http)
+                metrics.registry.observe(method, time.time() - start)
+                return response
+            except Exception as err:
+                if self.not_modified(request, err):
+                    # the caller's cached copy is current; not an error
+                    metrics.registry.observe(method, time.time() - start, cached=True)
+                    raise
+                if attempt >= self.retries or not self.retryable(err):
+                    metrics.registry.observe(method, time.time() - start, error=self.describe(err))
+                    raise
+
+            metrics.registry.retry(method)
+            time.sleep(self.backoff(attempt))
+            attempt += 1
+
+    @staticmethod
+    def not_modified(request, err):
+        # A 304 in answer to If-None-Match
+        return (isinstance(err, HttpError) and int(err.resp.status) == 304
+                and 'if-none-match' in [header.lower() for header in getattr(request, 'headers', {})])
+
+    @staticmethod
+    def describe(err):
+        if isinstance(err, HttpError):
+            return "HTTP %s" % err.resp.status
+        return err.__class__.__name__
+
+    def map(self, requests, httpFactory=None):
+        # Run requests on up to `workers` threads; with an httpFactory, each
+        # thread gets its own Http object from it. Returns
+        # [(response, exception)] in order.
+        local = threading.local()
+
+        def run(request):
+            if httpFactory is None:
+                return self.execute(request)
+            if not hasattr(local, 'http'):
+                local.http = httpFactory()
+            return self.execute(request, http=local.http)
+
+        return self.call_many([functools.partial(run, request) for request in requests])
+
+    def call_many(self, funcs):
+        # Call each of funcs on up to `workers` threads. Returns
+        # [(result, exception)] in order.
+        results = [None] * len(funcs)
+        queue = Queue.Queue()
+        for index, func in enumerate(funcs):
+            queue.put((index, func))
+
+        def worker():
+            while True:
+                try:
+                    index, func = queue.get_nowait()
+                except Queue.Empty:
+                    return
+                try:
+                    results[index] = (func(), None)
+                except (Exception, SystemExit) as err:
+                    results[index] = (None, err)
+
+        threads = []
+        for i in range(min(self.workers, len(funcs))):
+            thread = threading.Thread(target=worker)
+            thread.daemon = True
+            thread.start()
+            threads.append(thread)
+
+        for thread in threads:
+            thread.join()
+
+        return results
+
+    def batch(self, newBatch, requests, batchSize):
+        # Run (key, request) pairs as batch HTTP requests, batchSize at a time.
+        # Calls that fail with a retryable error are sent again in a later
+        # batch. Returns {key: (response, exception)}
+        results = {}
+        pending = list(requests)
+        attempt = 0
+
+        while pending:
+            retry = []
+            for start in range(0, len(pending), batchSize):
+                chunk = pending[start:start + batchSize]
+                ids = {}
+
+                def callback(request_id, response, exception):
+                    results[ids[request_id][0]] = (response, exception)
+                    if exception is not None and self.retryable(exception):
+                        retry.append(ids[request_id])
+
+                batch = newBatch(callback=callback)
+                for index, (key, request) in enumerate(chunk):
+                    ids[str(index)] = (key, request)
+                    batch.add(request, request_id=str(index))
+
+                self.bucket.take(len(chunk))
+                began = time.time()
+                try:
+                    batch.execute()
+                except Exception as err:
+                    metrics.registry.observe('batch', time.time() - began, error=self.describe(err))
+                    if not self.retryable(err):
+                        raise
+                    for key, request in chunk:
+                        results[key] = (None, err)
+                    retry.extend(chunk)
+                else:
+                    # every call in the batch took as long as the batch did
+                    elapsed = time.time() - began
+                    metrics.registry.observe('batch', elapsed)
+                    for key, request in chunk:
+                        response, exception = results.get(key, (None, None))
+                        method = getattr(request, 'methodId', None) or 'unknown'
+                        if exception is not None and self.not_modified(request, exception):
+                            metrics.registry.observe(method, elapsed, cached=True)
+                        else:
+                            metrics.registry.observe(method, elapsed, error=self.describe(exception) if exception is not None else None)
+
+            if not retry or attempt >= self.retries:
+                break
+
+            for key, request in retry:
+                metrics.registry.retry(getattr(request, 'methodId', None) or 'unknown')
+            time.sleep(self.backoff(attempt))
+            attempt += 1
+            pending = retry
+
+        return results
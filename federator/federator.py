@@ -1,9 +1,14 @@
 #!/usr/bin/env python
 
-from apiclient.discovery import build
+import cache
+import credentials as credential_manager
+import discovery
+import errors
+import executor
 import httplib2
+import metrics
+import transport
 from oauth2client import tools
-from oauth2client.file import Storage
 from oauth2client.client import AccessTokenRefreshError
 from oauth2client.client import OAuth2WebServerFlow
 import json
@@ -11,35 +16,93 @@ from googleapiclient.errors import HttpError
 import re
 import os
 import stat
-import sys
+import time
 from Crypto.Hash import SHA256
 
 class Federator(object):
     # we need multiple scopes, because we need to define a custom schema
-    # before being able to add roles defined within that schema to a user
-
-    def __init__(self, clientId=None, clientSecret=None, scope=None):
-        if scope is None:
-            raise Exception('No scope provided')
-
-        store = os.path.expanduser('~/.federator')
+    # before being able to add roles defined within that schema to a user.
+    # One token covers all of them, so a run touching both schemas and users
+    # only loads (and refreshes) one credential. The credential file is named
+    # by its scopes, so a subclass needing more (e.g. GroupMapping) has a
+    # credential of its own and existing ones keep working.
+    user_scope = "https://www.googleapis.com/auth/admin.directory.user"
+    schema_scope = "https://www.googleapis.com/auth/admin.directory.userschema"
+    group_scope = "https://www.googleapis.com/auth/admin.directory.group.member.readonly"
+    scopes = [user_scope, schema_scope]
+
+    # how long a cached discovery document is trusted before it's revalidated,
+    # and whether to avoid the network altogether when loading it
+    discoveryTtl = 86400
+    discoveryOffline = False
+
+    # where credentials and local state live, and an alternative API endpoint
+    # (e.g. a local stand-in for benchmarking); None means Google's own
+    storePath = '~/.federator'
+    rootUrl = None
+
+    # which set of credentials to use; None is the default set
+    profile = None
+
+    # all API calls go through one executor per process, so that the quota
+    # (queries per 100 seconds) is shared between every User and Schema
+    quota = 1500
+    workers = 10
+    sharedExecutor = None
+
+    def __init__(self, clientId=None, clientSecret=None, scope=None, profile=None):
+        if profile is not None:
+            self.profile = profile
+
+        if scope is None or scope in self.scopes:
+            scope = " ".join(self.scopes)
+
+        with metrics.registry.phase('credentials'):
+            store = self.credential_store(self.profile)
+            credentials = self.load_credentials(store, clientId=clientId, clientSecret=clientSecret, scope=scope)
+
+        self.credentials = credentials
+        self.http = transport.PooledHttp(self.new_http, size=self.workers, credentials=credentials)
+        self.store = store
+        with metrics.registry.phase('discovery'):
+            self.service = discovery.build_service(self.http, store,
+                    ttl=self.discoveryTtl, offline=self.discoveryOffline, rootUrl=self.rootUrl)
+
+    @classmethod
+    def credential_store(cls, profile=None):
+        # Each profile (e.g. one per Google Apps customer) gets its own
+        # credentials and local state in a directory under the main store.
+        # A classmethod so that commands which only need local state can find
+        # it without loading credentials.
+        if profile is None:
+            profile = cls.profile
+
+        store = cls.safe_directory(os.path.expanduser(cls.storePath))
+        if profile is not None:
+            store = cls.safe_directory(os.path.join(store, 'profiles'))
+            store = cls.safe_directory(os.path.join(store, profile))
+
+        return store
+
+    @staticmethod
+    def safe_directory(store):
         try:
             os.mkdir(store, 0700)
         except OSError as err:
             if err.strerror != 'File exists':
-                print("Cannot create credential store")
-                sys.exit(1)
+                raise errors.CredentialError("Cannot create credential store")
 
             # Verify the permissions
             res = os.stat(store)
             if not stat.S_ISDIR(res.st_mode):
-                print("%s is not a directory" % store)
-                sys.exit(1)
+                raise errors.CredentialError("%s is not a directory" % store)
 
             if (res.st_mode & stat.S_IRWXG) or (res.st_mode & stat.S_IRWXO):
-                print("Federator credentials directory %s is not safe; must be mode 0700" % store)
-                sys.exit(1)
+                raise errors.CredentialError("Federator credentials directory %s is not safe; must be mode 0700" % store)
+
+        return store
 
+    def load_credentials(self, store, clientId=None, clientSecret=None, scope=None):
         scope_hash = SHA256.new()
         scope_hash.update(scope)
         credfile = os.path.join(store, scope_hash.hexdigest())
@@ -49,110 +112,198 @@ class Federator(object):
             res = os.stat(credfile)
 
             if not stat.S_ISREG(res.st_mode):
-                print("Federator credentials file %s is not a regular file" % credfile)
-                sys.exit(1)
+                raise errors.CredentialError("Federator credentials file %s is not a regular file" % credfile)
 
             if (res.st_mode & stat.S_IRWXG) or (res.st_mode & stat.S_IRWXO) or (res.st_mode & stat.S_IXUSR):
-                print("Federator credentials file %s is not safe; must be mode 0600" % credfile)
-                sys.exit(1)
+                raise errors.CredentialError("Federator credentials file %s is not safe; must be mode 0600" % credfile)
 
         except OSError as err:
             if err.errno != 2:
                 raise
 
-        storage = Storage(credfile)
-        credentials = storage.get()
+        manager = credential_manager.CredentialManager.for_file(credfile)
+        credentials = manager.get()
 
-        if credentials is None or credentials.invalid:
+        if credentials is None:
             if clientId is None or clientSecret is None:
-                raise Exception("ERROR: No credentials defined. You must supply the CLIENTID and CLIENTSECRET arguments")
+                raise errors.CredentialError("ERROR: No credentials defined. You must supply the CLIENTID and CLIENTSECRET arguments")
 
             flow = OAuth2WebServerFlow(clientId, clientSecret, scope)
-            credentials = tools.run_flow(flow, storage, tools.argparser.parse_args())
+            credentials = tools.run_flow(flow, manager.storage, tools.argparser.parse_args())
+            manager.set(credentials)
 
         try:
             os.chmod(credfile, 0600)
-        except:
-            print("Cannot set mode of credentials file")
-            raise
+        except OSError as err:
+            raise errors.CredentialError("Cannot set mode of credentials file %s: %s" % (credfile, err))
+
+        return credentials
+
+    @classmethod
+    def executor(cls):
+        if Federator.sharedExecutor is None:
+            Federator.sharedExecutor = executor.Executor(quota=cls.quota, workers=cls.workers)
+
+        return Federator.sharedExecutor
 
-        self.http = httplib2.Http()
-        self.http = credentials.authorize(self.http)
-        self.service = build('admin', 'directory_v1', http=self.http)
+    def new_http(self):
+        # one connection for the pool behind self.http
+        return self.credentials.authorize(metrics.instrument(httplib2.Http(), metrics.registry))
+
+    def execute(self, request):
+        return self.executor().execute(request)
+
+    def execute_many(self, requests):
+        # self.http is a thread-safe pool, so the requests can share it
+        return self.executor().map(requests)
 
 class User(Federator):
     roleArnShape = re.compile('^arn:aws:iam::(\d{12}):role/(\w+)')
     providerArnShape = re.compile('^arn:aws:iam::\d{12}:saml-provider/\w+')
 
-    patchShape = """
-    {
-        "customSchemas": {
-            "AWS-SSO": {
-                "role": [
-                    {
-                        "value": "%s,%s",
-                        "customType": "%s"
-                    }
-                ]
-            }
-        }
-    }
-    """
+    # how many times to re-read and re-apply a change when someone else
+    # modified the user between our read and our patch
+    conflictRetries = 5
 
-    user_scope = "https://www.googleapis.com/auth/admin.directory.user"
+    # an iam.IamValidator to check ARNs really exist, or None to only check
+    # their shape
+    arnValidator = None
 
-    def __init__(self, userKey=None, clientId=None, clientSecret=None):
-        super(User, self).__init__(scope=self.user_scope, clientId=clientId, clientSecret=clientSecret)
+    def __init__(self, userKey=None, clientId=None, clientSecret=None, profile=None):
+        super(User, self).__init__(scope=self.user_scope, clientId=clientId, clientSecret=clientSecret, profile=profile)
         self.userKey = userKey
+        self.cache = cache.UserCache(self.store)
 
-    def get(self):
+    def fetch(self):
+        # Read the user, conditionally if we've seen it before: an unchanged
+        # user comes back as a 304 and is served from the local cache
+        cached = self.cache.get(self.userKey)
         request = self.service.users().get(userKey=self.userKey, projection='full')
-        return json.dumps(request.execute(), sort_keys=True, indent=4, separators=(',', ': '))
+        if cached is not None and cached.has_key('etag'):
+            request.headers['If-None-Match'] = cached['etag']
 
-    def get_current(self):
-        current = json.loads(self.get())
-        if current.has_key('customSchemas') and current['customSchemas'].has_key('AWS-SSO'):
-            current = current['customSchemas']['AWS-SSO']
-        else:
-            current = {'role':[], 'duration':3600}
+        try:
+            user = self.execute(request)
+        except HttpError as err:
+            if cached is not None and int(err.resp.status) == 304:
+                return cached
+            raise
+
+        self.cache.put(self.userKey, user)
+        return user
 
-        return current
+    def get(self):
+        return json.dumps(self.fetch(), sort_keys=True, indent=4, separators=(',', ': '))
+
+    def update(self, change, user=None):
+        # Read-modify-write with optimistic concurrency. change(current) is
+        # given the user's AWS-SSO block and returns (patch, result); a patch
+        # of None means there's nothing to do. The patch is only applied if
+        # the user still has the etag we read; if not, just this user is
+        # read again and the change re-applied.
+        for attempt in range(self.conflictRetries + 1):
+            if user is None:
+                user = self.fetch()
+
+            patch, result = change(self.sso_from(user))
+            if patch is None:
+                return result
+
+            request = self.service.users().patch(userKey=self.userKey, body=patch)
+            if user.has_key('etag'):
+                request.headers['If-Match'] = user['etag']
+
+            try:
+                self.execute(request)
+            except HttpError as err:
+                if int(err.resp.status) != 412:
+                    raise
+                user = None
+                continue
+            finally:
+                # whatever happened, our cached copy is now out of date
+                self.cache.invalidate(self.userKey)
+
+            return result
+
+        raise errors.ConflictError("User %s kept changing underneath us; gave up after %d attempts" % (self.userKey, self.conflictRetries + 1))
+
+    def iter_users(self, customer='my_customer', fields=None):
+        # Page through every user in the domain, asking only for the AWS-SSO
+        # custom schema. Yields one user dict at a time. A partial-response
+        # fields mask must include nextPageToken or paging stops early.
+        users = self.service.users()
+        params = {'customer': customer, 'projection': 'custom',
+                  'customFieldMask': 'AWS-SSO', 'maxResults': 500}
+        if fields is not None:
+            params['fields'] = fields
+
+        request = users.list(**params)
+        while request is not None:
+            response = self.execute(request)
+            for user in response.get('users', []):
+                yield user
+            request = users.list_next(request, response)
+
+    @staticmethod
+    def sso_from(user):
+        if user.has_key('customSchemas') and user['customSchemas'].has_key('AWS-SSO'):
+            return user['customSchemas']['AWS-SSO']
+
+        return {'role':[], 'duration':3600}
+
+    def get_current(self):
+        return self.sso_from(self.fetch())
 
     def set_duration(self, duration=3600):
-        current = self.get_current()
-        if current.has_key('duration') and current['duration'] == duration:
-            return
+        def change(current):
+            if current.has_key('duration') and current['duration'] == duration:
+                return None, None
 
-        current['duration'] = duration
-        patch = {'customSchemas':{'AWS-SSO':current}}
-        request = self.service.users().patch(userKey=self.userKey, body=patch)
-        response = request.execute()
+            current['duration'] = duration
+            return {'customSchemas':{'AWS-SSO':current}}, None
 
+        self.update(change)
 
-    def add_role(self, roleArn=None, providerArn=None):
-        # Make sure the ARNs are the right kind of shape
-        roleMatch = self.roleArnShape.match(roleArn)
+    def match_arns(self, roleArn=None, providerArn=None):
+        # Make sure the ARNs are the right kind of shape (and, with an
+        # arnValidator, that they exist); raises errors.InvalidArn if not
+        roleMatch = self.roleArnShape.match(roleArn or '')
         if not roleMatch:
-            print("Role ARN is incorrect; must be 'arn:aws:iam::<ACCOUNTID>:role/<SOMETHING>'")
-            return False
+            raise errors.InvalidArn("Role ARN is incorrect; must be 'arn:aws:iam::<ACCOUNTID>:role/<SOMETHING>'")
 
-        providerMatch = self.providerArnShape.match(providerArn)
+        providerMatch = self.providerArnShape.match(providerArn or '')
         if not providerMatch:
-            print("Provider ARN is incorrect; must be 'arn:aws:iam::<ACCOUNTID>:saml-provider/<SOMETHING>'")
-            return False
+            raise errors.InvalidArn("Provider ARN is incorrect; must be 'arn:aws:iam::<ACCOUNTID>:saml-provider/<SOMETHING>'")
+
+        if self.arnValidator is not None:
+            problems = self.arnValidator.check(roleArn, providerArn)
+            if problems:
+                raise errors.InvalidArn("; ".join(problems))
+
+        return roleMatch
 
+    def role_entry(self, roleArn, providerArn):
+        # The shape of a single role value in the AWS-SSO custom schema
+        roleMatch = self.roleArnShape.match(roleArn)
+        return {
+            'value': roleArn + "," + providerArn,
+            'customType': roleMatch.group(1) + '-' + roleMatch.group(2)
+        }
+
+    def add_role_patch(self, current, roleArn=None, providerArn=None):
         # We have to _add_ the patch to the existing set,
         # because the whole custom schema is replaced. We will only add it if the 
         # <rolearn>,<providerarn> tuple is different and if the customType name
         # is different. This means that we can't have two roles
-        # with the same name in the same account but with different SAML providers
-        current = self.get_current()
-        typeName = roleMatch.group(1) + '-' + roleMatch.group(2)
-        shape = self.patchShape % (roleArn, providerArn, typeName)
-        patch = json.loads(shape)
+        # with the same name in the same account but with different SAML providers.
+        # Returns None if the user already has the role.
+        entry = self.role_entry(roleArn, providerArn)
+        typeName = entry['customType']
+        patch = {'customSchemas': {'AWS-SSO': {'role': [entry]}}}
 
         do_add = True
-        for role in current['role']:
+        for role in current.get('role', []):
             if role['value'] == roleArn + "," + providerArn:
                 do_add = False
                 continue
@@ -164,30 +315,30 @@ class User(Federator):
             patch['customSchemas']['AWS-SSO']['role'].append(role)
 
         if not do_add:
-            print("That user already has access to that role")
-            return True
+            return None
 
         if current.has_key('duration'):
             patch['customSchemas']['AWS-SSO']['duration'] = current['duration']
 
-        request = self.service.users().patch(userKey=self.userKey, body=patch)
-        response = request.execute()
-        return roleMatch.group(2)
+        return patch
 
-    def remove_role(self, roleArn=None, providerArn=None, customType=None):
-        if roleArn is None and providerArn is None and customType is None:
-            print("ERROR: You must specify the Role ARN and the Provider ARN, or the Custom Type")
-            return False
+    def add_role(self, roleArn=None, providerArn=None):
+        # Returns the role's name, or None if the user already has it
+        roleMatch = self.match_arns(roleArn, providerArn)
 
-        # Removing a role is similar to adding one -- we need to update the current
-        # custom schema set and re-patch the user.
-        current = json.loads(self.get())
-        if current.has_key('customSchemas') and current['customSchemas'].has_key('AWS-SSO'):
-            current = current['customSchemas']['AWS-SSO']
-        else:
-            # there are no custom roles associated
-            return "user has no roles"
+        def change(current):
+            patch = self.add_role_patch(current, roleArn, providerArn)
+            return patch, patch is not None
 
+        if not self.update(change):
+            return None
+
+        return roleMatch.group(2)
+
+    def remove_role_patch(self, current, roleArn=None, providerArn=None, customType=None):
+        # Removing a role is similar to adding one -- we need to update the current
+        # custom schema set and re-patch the user. Returns the new patch and
+        # whatever was removed (None if nothing matched)
         new_shape = {
             'customSchemas': {
                 'AWS-SSO': {
@@ -196,8 +347,11 @@ class User(Federator):
             }
         }
 
+        if current.has_key('duration'):
+            new_shape['customSchemas']['AWS-SSO']['duration'] = current['duration']
+
         removed = None
-        for role in current['role']:
+        for role in current.get('role', []):
             # copy all the roles across to the new list, unless it matches the one
             # that we're removing
             if customType:
@@ -210,18 +364,131 @@ class User(Federator):
                     removed = value
                     continue
             else:
-                print("I don't know how I got here")
-                sys.exit(1)
+                raise errors.InvalidRequest("You must specify either the Custom Type, or both Role and Provider ARNs")
 
             new_shape['customSchemas']['AWS-SSO']['role'].append(role)
 
-        if removed:
-            request = self.service.users().patch(userKey=self.userKey, body=new_shape)
-            response = request.execute()
+        return new_shape, removed
+
+    def remove_role(self, roleArn=None, providerArn=None, customType=None):
+        if roleArn is None and providerArn is None and customType is None:
+            raise errors.InvalidRequest("You must specify the Role ARN and the Provider ARN, or the Custom Type")
+
+        user = self.fetch()
+        if not (user.has_key('customSchemas') and user['customSchemas'].has_key('AWS-SSO')):
+            # there are no custom roles associated
+            return "user has no roles"
+
+        def change(current):
+            new_shape, removed = self.remove_role_patch(current,
+                    roleArn=roleArn, providerArn=providerArn, customType=customType)
+            if not removed:
+                return None, None
+            return new_shape, removed
+
+        return self.update(change, user=user)
+
+    def edit(self):
+        # Start a set of changes to this user that are applied together; see
+        # Edit
+        return Edit(self)
+
+class Edit(object):
+    # Several changes to one user's AWS-SSO block, made with one read and
+    # one patch, so no partial state is ever visible:
+    #
+    #   with user.edit() as edit:
+    #       edit.add(roleArn, providerArn)
+    #       edit.remove(customType='123456789012-Old')
+    #       edit.duration(7200)
+    #
+    # or call edit.commit() directly. Removals are applied first, then
+    # additions (with the same rules as User.add_role), then the duration.
+    # If the user changes between the read and the patch, the whole edit is
+    # re-applied to the new state.
+
+    def __init__(self, user):
+        self.user = user
+        self.adds = []
+        self.removes = []
+        self.newDuration = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, type, value, traceback):
+        if type is None:
+            self.commit()
+
+    def add(self, roleArn, providerArn):
+        self.user.match_arns(roleArn, providerArn)
+        self.adds.append(self.user.role_entry(roleArn, providerArn))
+        return self
+
+    def remove(self, roleArn=None, providerArn=None, customType=None):
+        if customType is not None:
+            self.removes.append(('customType', customType))
+        elif roleArn and providerArn:
+            self.removes.append(('value', roleArn + "," + providerArn))
+        else:
+            raise errors.InvalidRequest("You must specify either the Custom Type, or both Role and Provider ARNs")
+        return self
+
+    def duration(self, duration):
+        self.newDuration = int(duration)
+        return self
+
+    def options(self, add=None, remove=None, duration=None):
+        # Queue changes given as strings, as on the command line: roles to
+        # add as "roleArn,providerArn", roles to remove either that way or
+        # by custom type
+        for pair in add or []:
+            roleArn, _, providerArn = pair.partition(',')
+            self.add(roleArn, providerArn)
+        for role in remove or []:
+            if ',' in role:
+                roleArn, _, providerArn = role.partition(',')
+                self.remove(roleArn=roleArn, providerArn=providerArn)
+            else:
+                self.remove(customType=role)
+        if duration is not None:
+            self.duration(duration)
+        return self
+
+    def apply(self, current):
+        # Returns (patch, changes) for the given AWS-SSO block; changes is a
+        # list of human-readable lines, and the patch is None if it's empty
+        roles = list(current.get('role', []))
+        changes = []
+
+        for key, wanted in self.removes:
+            kept = [role for role in roles if role.get(key) != wanted]
+            if len(kept) != len(roles):
+                changes.append("- %s" % wanted)
+            roles = kept
+
+        for entry in self.adds:
+            values = set(role['value'] for role in roles)
+            types = set(role['customType'] for role in roles)
+            if entry['value'] in values or entry['customType'] in types:
+                continue
+            roles.append(entry)
+            changes.append("+ %s" % entry['value'])
 
-        return removed
+        block = {'role': roles}
+        if current.has_key('duration'):
+            block['duration'] = current['duration']
+        if self.newDuration is not None and str(current.get('duration')) != str(self.newDuration):
+            block['duration'] = self.newDuration
+            changes.append("~ duration %s -> %s" % (current.get('duration'), self.newDuration))
 
+        if not changes:
+            return None, changes
+        return {'customSchemas': {'AWS-SSO': block}}, changes
 
+    def commit(self):
+        # Returns the list of changes made; empty if there was nothing to do
+        return self.user.update(self.apply)
 
 class Schema(Federator):
     rawSchema = """
@@ -245,52 +512,72 @@ class Schema(Federator):
     """
     customSchema = json.loads(rawSchema)
 
-    schema_scope = "https://www.googleapis.com/auth/admin.directory.userschema"
+    # Recently fetched schemas, shared by all Schema objects in the process:
+    # {(profile, customerId): (time fetched, schema or None)}
+    schemaCacheTtl = 60
+    schemaCache = {}
 
-    def __init__(self, customerId=None, clientId=None, clientSecret=None):
-        super(Schema, self).__init__(scope=self.schema_scope, clientId=clientId, clientSecret=clientSecret)
+    def __init__(self, customerId=None, clientId=None, clientSecret=None, profile=None):
+        super(Schema, self).__init__(scope=self.schema_scope, clientId=clientId, clientSecret=clientSecret, profile=profile)
         self.customerId = customerId
 
     def list(self):
         request = self.service.schemas().list(customerId=self.customerId)
-        response = request.execute()
+        response = self.execute(request)
         return response
 
-    def get(self):
+    def fetch(self):
+        # The AWS-SSO schema, or None if the customer doesn't have one. Asks
+        # for it directly rather than listing every schema, and remembers the
+        # answer for a little while.
+        cacheKey = (self.profile, self.customerId)
+        if self.schemaCache.has_key(cacheKey):
+            fetched, schema = self.schemaCache[cacheKey]
+            if time.time() - fetched < self.schemaCacheTtl:
+                return schema
+
         key = self.customSchema['schemaName']
         request = self.service.schemas().get(customerId=self.customerId, schemaKey=key)
-        response = request.execute()
-        return json.dumps(response, sort_keys=True, indent=4, separators=(',', ': '))
+        try:
+            schema = self.execute(request)
+        except HttpError as err:
+            if int(err.resp.status) != 404:
+                raise
+            schema = None
 
-    def exists(self):
-        request = self.service.schemas().list(customerId=self.customerId)
-        response = request.execute()
-        for schema in response['schemas']:
-            if schema['schemaName'] == "AWS-SSO":
-                return True
+        self.schemaCache[cacheKey] = (time.time(), schema)
+        return schema
+
+    def forget(self):
+        self.schemaCache.pop((self.profile, self.customerId), None)
 
-        return False
+    def get(self):
+        return json.dumps(self.fetch(), sort_keys=True, indent=4, separators=(',', ': '))
+
+    def exists(self):
+        return self.fetch() is not None
 
     def create(self):
+        # True if the schema was created, False if it already existed
+        self.forget()
         request = self.service.schemas().insert(customerId=self.customerId, body=self.customSchema)
 
         try:
-            response = request.execute()
+            response = self.execute(request)
         except HttpError as err:
-            print(err.resp)
             if err.resp['status'] == '412':
-                print("Schema already exists")
-            else:
-                raise
+                return False
+            raise
 
         return True
 
     def delete(self):
+        self.forget()
         key = self.customSchema['schemaName']
         request = self.service.schemas().delete(customerId=self.customerId, schemaKey=key)
 
         try:
-            response = request.execute()
+            response = self.execute(request)
         except HttpError as err:
             if err.resp['status'] == '400':
                 return False
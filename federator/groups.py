@@ -0,0 +1,92 @@
+#!/usr/bin/env python
+
+import errors
+import json
+from bulk import Bulk
+from federator import Federator
+
+class GroupMapping(Bulk):
+    # Grant roles by Google Group membership. The mapping file looks like
+    #
+    #   {
+    #       "aws-admins@example.com": [
+    #           {"role": "arn:aws:iam::...:role/Admin", "provider": "arn:aws:iam::...:saml-provider/Google"}
+    #       ]
+    #   }
+    #
+    # Groups are expanded through members.list, following nested groups;
+    # each group is only fetched once per run, however many of the mapped
+    # groups contain it. The roles are then added to every member in bulk.
+
+    # reading group membership needs one more scope than everything else
+    scopes = Federator.scopes + [Federator.group_scope]
+
+    def __init__(self, clientId=None, clientSecret=None, batchSize=None):
+        super(GroupMapping, self).__init__(clientId=clientId, clientSecret=clientSecret, batchSize=batchSize)
+        self.memo = {}
+
+    @staticmethod
+    def read_mapping(path):
+        with open(path) as mapping:
+            return json.load(mapping)
+
+    def direct_members(self, groupKey):
+        members = self.service.members()
+        request = members.list(groupKey=groupKey, maxResults=200,
+                fields='nextPageToken,members(email,type,status)')
+        while request is not None:
+            response = self.execute(request)
+            for member in response.get('members', []):
+                yield member
+            request = members.list_next(request, response)
+
+    def expand(self, groupKey):
+        # Returns the set of user email addresses in the group, including
+        # those in nested groups
+        return self.expand_nested(groupKey.lower(), ())[0]
+
+    def expand_nested(self, groupKey, parents):
+        # Returns (users, complete). A group that's part of a membership loop
+        # is cut short while the loop is being walked, so that partial answer
+        # isn't memoised; the group is expanded properly when asked directly.
+        if self.memo.has_key(groupKey):
+            return self.memo[groupKey], True
+
+        users = set()
+        complete = True
+        for member in self.direct_members(groupKey):
+            email = member.get('email', '').lower()
+            if member.get('type') == 'GROUP':
+                if email in parents or email == groupKey:
+                    complete = False
+                    continue
+                nested, nestedComplete = self.expand_nested(email, parents + (groupKey,))
+                users |= nested
+                complete = complete and nestedComplete
+            elif member.get('type') == 'USER' and member.get('status', 'ACTIVE') == 'ACTIVE':
+                users.add(email)
+
+        if complete or not parents:
+            self.memo[groupKey] = users
+        return users, complete
+
+    def rows(self, mapping):
+        # The manifest rows (as for Bulk.apply) that grant every mapped role
+        # to every member of its group
+        rows = []
+        seen = set()
+        for groupKey in sorted(mapping):
+            for role in mapping[groupKey]:
+                try:
+                    self.match_arns(role.get('role'), role.get('provider'))
+                except errors.InvalidArn as err:
+                    raise errors.InvalidArn("Invalid ARN for group %s: %s (%s)" % (groupKey, role, err))
+                for userKey in sorted(self.expand(groupKey)):
+                    key = (userKey, role['role'], role['provider'])
+                    if key in seen:
+                        continue
+                    seen.add(key)
+                    rows.append({'userKey': userKey, 'roleArn': role['role'],
+                                 'providerArn': role['provider'], 'action': 'add'})
+
+        return rows
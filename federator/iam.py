@@ -0,0 +1,138 @@
+#!/usr/bin/env python
+
+import cache
+import errno
+import json
+import os
+import threading
+import time
+
+try:
+    import boto3
+except ImportError:
+    boto3 = None
+
+class IamValidator(object):
+    # Check role and SAML provider ARNs against what actually exists in IAM,
+    # so typos and deleted providers are caught before they reach Google.
+    # Each account's roles (one paginated ListRoles) and SAML providers (one
+    # ListSAMLProviders) are fetched once and kept for `ttl` seconds, in
+    # memory and under ~/.federator/iam, so a bulk job checks thousands of
+    # assignments for a few API calls per account.
+    #
+    # Needs boto3 (pip install google-aws-federator[iam]). By default the
+    # ambient AWS credentials are used, which can only see their own
+    # account; give assumeRole (a role name) to check other accounts by
+    # assuming that role in each. endpointUrl points IAM and STS somewhere
+    # else, e.g. a local moto server.
+
+    ttl = 3600
+
+    def __init__(self, store=None, ttl=None, assumeRole=None, endpointUrl=None, session=None):
+        if boto3 is None:
+            raise ImportError("IAM validation needs boto3; pip install boto3")
+
+        if store is None:
+            store = os.path.expanduser('~/.federator')
+        self.path = os.path.join(store, 'iam')
+        try:
+            os.mkdir(self.path, 0700)
+        except OSError as err:
+            if err.errno != errno.EEXIST:
+                raise
+
+        if ttl is not None:
+            self.ttl = ttl
+        self.assumeRole = assumeRole
+        self.endpointUrl = endpointUrl
+        self.session = session or boto3.Session()
+        self.callerAccount = None
+        self.catalogs = {}
+        # accounts we couldn't read, so they aren't retried for every ARN
+        self.failures = {}
+        self.lock = threading.Lock()
+
+    @staticmethod
+    def account_of(arn):
+        return arn.split(':')[4]
+
+    def client(self, service, session=None):
+        return (session or self.session).client(service, endpoint_url=self.endpointUrl)
+
+    def session_for(self, accountId):
+        # A boto3 session that can read IAM in the given account
+        if self.assumeRole is not None:
+            credentials = self.client('sts').assume_role(
+                    RoleArn='arn:aws:iam::%s:role/%s' % (accountId, self.assumeRole),
+                    RoleSessionName='federator-validate')['Credentials']
+            return boto3.Session(aws_access_key_id=credentials['AccessKeyId'],
+                    aws_secret_access_key=credentials['SecretAccessKey'],
+                    aws_session_token=credentials['SessionToken'])
+
+        if self.callerAccount is None:
+            self.callerAccount = self.client('sts').get_caller_identity()['Account']
+        if self.callerAccount != accountId:
+            raise ValueError("AWS credentials are for account %s; use an assumable role to check %s"
+                    % (self.callerAccount, accountId))
+        return self.session
+
+    def fetch(self, accountId):
+        session = self.session_for(accountId)
+        iam = self.client('iam', session)
+
+        roles = []
+        for page in iam.get_paginator('list_roles').paginate():
+            roles.extend(role['Arn'] for role in page['Roles'])
+        providers = [provider['Arn'] for provider in iam.list_saml_providers()['SAMLProviderList']]
+
+        return {'fetched': time.time(), 'roles': roles, 'providers': providers}
+
+    def filename(self, accountId):
+        return os.path.join(self.path, '%s.json' % accountId)
+
+    def read_cache(self, accountId):
+        try:
+            with open(self.filename(accountId)) as cached:
+                catalog = json.load(cached)
+        except (IOError, ValueError):
+            return None
+        if time.time() - catalog.get('fetched', 0) > self.ttl:
+            return None
+        return catalog
+
+    def write_cache(self, accountId, catalog):
+        cache.atomic_write(self.filename(accountId), json.dumps(catalog))
+
+    def catalog(self, accountId):
+        # {'roles': set of ARNs, 'providers': set of ARNs} for the account
+        with self.lock:
+            catalog = self.catalogs.get(accountId)
+            if catalog is None or time.time() - catalog['fetched'] > self.ttl:
+                catalog = self.read_cache(accountId)
+                if catalog is None:
+                    catalog = self.fetch(accountId)
+                    self.write_cache(accountId, catalog)
+                catalog = {'fetched': catalog['fetched'], 'roles': set(catalog['roles']),
+                           'providers': set(catalog['providers'])}
+                self.catalogs[accountId] = catalog
+            return catalog
+
+    def problem(self, arn):
+        # None if the role or SAML provider exists, otherwise what's wrong
+        kind = 'providers' if ':saml-provider/' in arn else 'roles'
+        accountId = self.account_of(arn)
+        if not self.failures.has_key(accountId):
+            try:
+                catalog = self.catalog(accountId)
+            except Exception as err:
+                self.failures[accountId] = str(err)
+        if self.failures.has_key(accountId):
+            return "Could not check %s against IAM: %s" % (arn, self.failures[accountId])
+
+        if arn not in catalog[kind]:
+            return "%s does not exist in IAM" % arn
+        return None
+
+    def check(self, roleArn, providerArn):
+        # A list of problems with a role/provider pair; empty if both exist
+        return [problem for problem in (self.problem(roleArn), self.problem(providerArn)) if problem]
@@ -0,0 +1,137 @@
+#!/usr/bin/env python
+
+import errno
+import os
+import sqlite3
+from federator import User
+
+class RoleIndex(object):
+    # A local SQLite index of the AWS-SSO custom schema values for the whole
+    # domain, so that "who holds this role?" doesn't need a directory scan.
+    # refresh() re-reads the user list but only rewrites users whose etag
+    # has changed since the last refresh.
+
+    usersMask = 'nextPageToken,users(primaryEmail,etag,customSchemas)'
+
+    tables = [
+        """CREATE TABLE IF NOT EXISTS users (
+            userKey TEXT PRIMARY KEY,
+            etag TEXT,
+            duration INTEGER
+        )""",
+        """CREATE TABLE IF NOT EXISTS roles (
+            userKey TEXT NOT NULL,
+            role TEXT NOT NULL,
+            provider TEXT NOT NULL,
+            account TEXT,
+            customType TEXT
+        )""",
+        "CREATE INDEX IF NOT EXISTS roles_user ON roles (userKey)",
+        "CREATE INDEX IF NOT EXISTS roles_role ON roles (role)",
+        "CREATE INDEX IF NOT EXISTS roles_provider ON roles (provider)",
+        "CREATE INDEX IF NOT EXISTS roles_account ON roles (account)",
+        "CREATE INDEX IF NOT EXISTS roles_type ON roles (customType)",
+    ]
+
+    def __init__(self, store=None):
+        if store is None:
+            store = os.path.expanduser('~/.federator')
+
+        # as private as the credential store it normally lives in
+        try:
+            os.makedirs(store, 0700)
+        except OSError as err:
+            if err.errno != errno.EEXIST:
+                raise
+
+        self.path = os.path.join(store, 'index.sqlite')
+        self.db = sqlite3.connect(self.path)
+        os.chmod(self.path, 0600)
+        for table in self.tables:
+            self.db.execute(table)
+        self.db.commit()
+
+    def close(self):
+        self.db.close()
+
+    def empty(self):
+        return self.db.execute("SELECT COUNT(*) FROM users").fetchone()[0] == 0
+
+    def etag(self, userKey):
+        # The etag of the indexed copy of a user, or None
+        row = self.db.execute("SELECT etag FROM users WHERE userKey = ?", (userKey,)).fetchone()
+        return row[0] if row else None
+
+    def store_user(self, userKey, user):
+        self.db.execute("DELETE FROM roles WHERE userKey = ?", (userKey,))
+        # not sso_from(), whose default duration would be stored for users
+        # who have no AWS-SSO block at all
+        sso = user.get('customSchemas', {}).get('AWS-SSO', {})
+        self.db.execute("INSERT OR REPLACE INTO users (userKey, etag, duration) VALUES (?, ?, ?)",
+                (userKey, user.get('etag'), sso.get('duration')))
+
+        for role in sso.get('role', []):
+            roleArn, _, providerArn = role['value'].partition(',')
+            roleMatch = User.roleArnShape.match(roleArn)
+            account = roleMatch.group(1) if roleMatch else None
+            self.db.execute("INSERT INTO roles (userKey, role, provider, account, customType) VALUES (?, ?, ?, ?, ?)",
+                    (userKey, roleArn, providerArn, account, role.get('customType')))
+
+    def remove_user(self, userKey):
+        self.db.execute("DELETE FROM roles WHERE userKey = ?", (userKey,))
+        self.db.execute("DELETE FROM users WHERE userKey = ?", (userKey,))
+
+    def refresh(self, users, customer='my_customer', changed=None):
+        # users is a User, used for its API service. Returns the number of
+        # users added, changed or removed; if changed is a list, their keys
+        # are appended to it.
+        known = dict(self.db.execute("SELECT userKey, etag FROM users"))
+        seen = set()
+        count = 0
+
+        for user in users.iter_users(customer=customer, fields=self.usersMask):
+            userKey = user['primaryEmail'].lower()
+            seen.add(userKey)
+            if known.has_key(userKey) and known[userKey] == user.get('etag'):
+                continue
+            self.store_user(userKey, user)
+            count += 1
+            if changed is not None:
+                changed.append(userKey)
+
+        for userKey in set(known) - seen:
+            self.remove_user(userKey)
+            count += 1
+            if changed is not None:
+                changed.append(userKey)
+
+        self.db.commit()
+        return count
+
+    def lookup(self, role=None, provider=None, account=None, customType=None):
+        # Returns the sorted user keys holding roles that match all of the
+        # given criteria
+        where = []
+        params = []
+        for column, value in (('role', role), ('provider', provider), ('account', account), ('customType', customType)):
+            if value is not None:
+                where.append("%s = ?" % column)
+                params.append(value)
+
+        if not where:
+            raise ValueError("Nothing to look up")
+
+        query = "SELECT DISTINCT userKey FROM roles WHERE %s ORDER BY userKey" % " AND ".join(where)
+        return [row[0] for row in self.db.execute(query, params)]
+
+    def members(self, arn):
+        # Users holding a role ARN, trusting a saml-provider ARN, or with any
+        # role in an account (given a bare 12-digit account ID)
+        if User.roleArnShape.match(arn):
+            return self.lookup(role=arn)
+        if User.providerArnShape.match(arn):
+            return self.lookup(provider=arn)
+        if arn.isdigit() and len(arn) == 12:
+            return self.lookup(account=arn)
+
+        return self.lookup(customType=arn)
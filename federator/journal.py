@@ -0,0 +1,92 @@
+#!/usr/bin/env python
+
+import errno
+import json
+import os
+import time
+from Crypto.Hash import SHA256
+
+class Journal(object):
+    # An append-only record of a multi-user job: one JSON line when a patch
+    # for a user is planned (with the etag it was planned against) and one
+    # when it's done. If the job dies part-way, running it again with resume
+    # skips the users that are done; the ones that were in flight (see
+    # in_flight) can have their patch sent again, conditional on the etag it
+    # was planned against. The journal is removed once the whole job has
+    # succeeded.
+
+    def __init__(self, path, resume=False):
+        self.path = path
+        self.planned = {}
+        self.done = {}
+
+        if resume:
+            self.replay()
+
+        # a fresh run starts a fresh journal
+        self.out = open(path, 'a' if resume else 'w')
+        os.chmod(path, 0600)
+
+    @classmethod
+    def for_job(cls, store, name, inputs, resume=False):
+        # The journal for a job is named by what it was asked to do, so that
+        # the same command with the same input finds it again
+        job_hash = SHA256.new()
+        job_hash.update(name)
+        for item in inputs:
+            job_hash.update("\0" + item)
+
+        directory = os.path.join(store, 'journal')
+        try:
+            os.mkdir(directory, 0700)
+        except OSError as err:
+            if err.errno != errno.EEXIST:
+                raise
+
+        return cls(os.path.join(directory, '%s-%s.jsonl' % (name, job_hash.hexdigest()[:16])), resume=resume)
+
+    @staticmethod
+    def file_input(path):
+        with open(path) as contents:
+            return contents.read()
+
+    def replay(self):
+        try:
+            with open(self.path) as journal:
+                for line in journal:
+                    try:
+                        record = json.loads(line)
+                    except ValueError:
+                        # the last line may be half-written if we were killed
+                        continue
+                    if record['event'] == 'planned':
+                        self.planned[record['userKey']] = record
+                    elif record['event'] == 'done':
+                        self.done[record['userKey']] = record
+        except IOError as err:
+            if err.errno != errno.ENOENT:
+                raise
+
+    def write(self, record):
+        record['time'] = time.time()
+        self.out.write(json.dumps(record, sort_keys=True) + "\n")
+        self.out.flush()
+
+    def plan(self, userKey, etag, patch):
+        self.planned[userKey] = {'event': 'planned', 'userKey': userKey, 'etag': etag, 'patch': patch}
+        self.write(dict(self.planned[userKey]))
+
+    def complete(self, userKey, status='updated'):
+        self.done[userKey] = {'event': 'done', 'userKey': userKey, 'status': status}
+        self.write(dict(self.done[userKey]))
+
+    def is_done(self, userKey):
+        return self.done.has_key(userKey)
+
+    def in_flight(self):
+        return [userKey for userKey in self.planned if not self.done.has_key(userKey)]
+
+    def finish(self, succeeded=True):
+        self.out.close()
+        if succeeded:
+            os.unlink(self.path)
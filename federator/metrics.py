@@ -0,0 +1,183 @@
+#!/usr/bin/env python
+
+from contextlib import contextmanager
+import json
+import threading
+import time
+
+# Counters and latency histograms for everything Federator sends to Google:
+# per API method (from Executor), per raw HTTP request (from the instrumented
+# httplib2.Http objects, which also see token refreshes) and for the startup
+# phases. Written out as JSON or a Prometheus textfile-collector file.
+
+class Histogram(object):
+    buckets = [0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0]
+
+    def __init__(self):
+        self.counts = [0] * (len(self.buckets) + 1)
+        self.total = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        self.total += value
+        self.count += 1
+        for index, bound in enumerate(self.buckets):
+            if value <= bound:
+                self.counts[index] += 1
+                return
+        self.counts[-1] += 1
+
+    def cumulative(self):
+        # (upper bound, count of observations <= bound), Prometheus-style
+        running = 0
+        result = []
+        for bound, count in zip([str(bound) for bound in self.buckets] + ['+Inf'], self.counts):
+            running += count
+            result.append((bound, running))
+        return result
+
+    def as_dict(self):
+        return {'count': self.count, 'sum': self.total, 'buckets': dict(self.cumulative())}
+
+class Metrics(object):
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.calls = {}
+        self.latency = {}
+        self.errors = {}
+        self.retries = {}
+        # conditional reads answered with 304 Not Modified
+        self.cacheHits = {}
+        self.phases = {}
+        self.http = {'requests': 0, 'bytesSent': 0, 'bytesReceived': 0, 'tokenRefreshes': 0}
+        self.trace = None
+
+    def start_trace(self, path):
+        self.trace = open(path, 'a')
+
+    def write_trace(self, record):
+        if self.trace is not None:
+            with self.lock:
+                self.trace.write(json.dumps(record, sort_keys=True) + "\n")
+                self.trace.flush()
+
+    def observe(self, method, elapsed, error=None, cached=False):
+        # one API call (including any retries) as seen by the executor
+        with self.lock:
+            self.calls[method] = self.calls.get(method, 0) + 1
+            self.latency.setdefault(method, Histogram()).observe(elapsed)
+            if cached:
+                self.cacheHits[method] = self.cacheHits.get(method, 0) + 1
+            if error is not None:
+                key = (method, str(error))
+                self.errors[key] = self.errors.get(key, 0) + 1
+
+    def retry(self, method):
+        with self.lock:
+            self.retries[method] = self.retries.get(method, 0) + 1
+
+    def http_request(self, uri, method, status, elapsed, sent, received):
+        refresh = 'oauth2' in uri and 'token' in uri
+        with self.lock:
+            self.http['requests'] += 1
+            self.http['bytesSent'] += sent
+            self.http['bytesReceived'] += received
+            if refresh:
+                self.http['tokenRefreshes'] += 1
+
+        self.write_trace({'time': time.time(), 'method': method, 'uri': uri.split('?')[0],
+            'status': status, 'seconds': elapsed, 'sent': sent, 'received': received})
+
+    @contextmanager
+    def phase(self, name):
+        start = time.time()
+        try:
+            yield
+        finally:
+            elapsed = time.time() - start
+            with self.lock:
+                self.phases[name] = self.phases.get(name, 0.0) + elapsed
+
+    def summary(self):
+        with self.lock:
+            return {
+                'calls': dict(self.calls),
+                'latency': dict((method, histogram.as_dict()) for method, histogram in self.latency.items()),
+                'errors': [{'method': method, 'error': error, 'count': count} for (method, error), count in sorted(self.errors.items())],
+                'retries': dict(self.retries),
+                'cacheHits': dict(self.cacheHits),
+                'phases': dict(self.phases),
+                'http': dict(self.http),
+            }
+
+    def prometheus(self):
+        summary = self.summary()
+        lines = []
+
+        def metric(name, kind, help, samples):
+            lines.append("# HELP federator_%s %s" % (name, help))
+            lines.append("# TYPE federator_%s %s" % (name, kind))
+            for labels, value in samples:
+                label = ",".join('%s="%s"' % (key, str(val).replace('"', '\\"')) for key, val in labels)
+                lines.append("federator_%s%s %s" % (name, "{%s}" % label if label else "", value))
+
+        metric('api_calls_total', 'counter', 'API calls by method',
+            [((('method', method),), count) for method, count in sorted(summary['calls'].items())])
+        metric('api_retries_total', 'counter', 'API call retries by method',
+            [((('method', method),), count) for method, count in sorted(summary['retries'].items())])
+        metric('api_cache_hits_total', 'counter', 'Conditional reads answered with 304 Not Modified, by method',
+            [((('method', method),), count) for method, count in sorted(summary['cacheHits'].items())])
+        metric('api_errors_total', 'counter', 'API calls that failed, by method and error',
+            [((('method', error['method']), ('error', error['error'][:100])), error['count']) for error in summary['errors']])
+
+        lines.append("# HELP federator_api_call_seconds API call latency, including retries")
+        lines.append("# TYPE federator_api_call_seconds histogram")
+        for method in sorted(self.latency):
+            histogram = self.latency[method]
+            for bound, count in histogram.cumulative():
+                lines.append('federator_api_call_seconds_bucket{method="%s",le="%s"} %s' % (method, bound, count))
+            lines.append('federator_api_call_seconds_sum{method="%s"} %s' % (method, histogram.total))
+            lines.append('federator_api_call_seconds_count{method="%s"} %s' % (method, histogram.count))
+
+        metric('http_requests_total', 'counter', 'Raw HTTP requests, including token refreshes', [((), summary['http']['requests'])])
+        metric('http_sent_bytes_total', 'counter', 'Request body bytes sent', [((), summary['http']['bytesSent'])])
+        metric('http_received_bytes_total', 'counter', 'Response body bytes received', [((), summary['http']['bytesReceived'])])
+        metric('token_refreshes_total', 'counter', 'OAuth2 access token refreshes', [((), summary['http']['tokenRefreshes'])])
+        metric('phase_seconds', 'gauge', 'Time spent in each startup phase',
+            [((('phase', phase),), seconds) for phase, seconds in sorted(summary['phases'].items())])
+
+        return "\n".join(lines) + "\n"
+
+    def write(self, path):
+        # Prometheus textfile-collector format for .prom files, JSON otherwise.
+        # Written to a temporary file first, as the textfile collector expects,
+        # and left readable by the collector (which often runs as another user).
+        # cache is imported here, as it loads Crypto which --help shouldn't
+        import cache
+        if path.endswith('.prom'):
+            content = self.prometheus()
+        else:
+            content = json.dumps(self.summary(), sort_keys=True, indent=4, separators=(',', ': ')) + "\n"
+
+        cache.atomic_write(path, content, mode=0644)
+
+def instrument(http, metrics):
+    # Wrap an httplib2.Http so every request it makes is counted. Do this
+    # before credentials.authorize(), so token refreshes are seen too.
+    original = http.request
+
+    def request(uri, method='GET', body=None, headers=None, *args, **kwargs):
+        start = time.time()
+        try:
+            resp, content = original(uri, method, body, headers, *args, **kwargs)
+        except Exception:
+            metrics.http_request(uri, method, None, time.time() - start, len(body or ''), 0)
+            raise
+
+        metrics.http_request(uri, method, resp.status, time.time() - start, len(body or ''), len(content or ''))
+        return resp, content
+
+    http.request = request
+    return http
+
+registry = Metrics()
@@ -0,0 +1,109 @@
+#!/usr/bin/env python
+
+import copy
+from federator import Federator, User
+
+class Migration(User):
+    # Rewrite every role value that mentions one ARN to use another, e.g.
+    # when a SAML provider is rotated or an IAM role renamed. Only the users
+    # a Directory API search says hold the old ARN are read, and they're
+    # patched concurrently, so the cost grows with the number of affected
+    # users rather than the size of the directory.
+
+    usersMask = 'nextPageToken,users(primaryEmail,etag,customSchemas)'
+
+    def __init__(self, fromArn=None, toArn=None, customerId='my_customer', clientId=None, clientSecret=None):
+        super(Migration, self).__init__(userKey=None, clientId=clientId, clientSecret=clientSecret)
+        self.customerId = customerId
+
+        if self.roleArnShape.match(fromArn or '') and self.roleArnShape.match(toArn or ''):
+            self.field = 0
+        elif self.providerArnShape.match(fromArn or '') and self.providerArnShape.match(toArn or ''):
+            self.field = 1
+        else:
+            raise ValueError("--from and --to must both be role ARNs, or both be saml-provider ARNs")
+
+        if self.arnValidator is not None:
+            problem = self.arnValidator.problem(toArn)
+            if problem is not None:
+                raise ValueError(problem)
+
+        self.fromArn = fromArn
+        self.toArn = toArn
+
+    def affected(self):
+        # Users whose AWS-SSO roles mention the old ARN. The search narrows
+        # things down on Google's side; the check here makes it exact.
+        users = self.service.users()
+        request = users.list(customer=self.customerId, projection='custom', customFieldMask='AWS-SSO',
+                query="AWS-SSO.role:'%s'" % self.fromArn, maxResults=500, fields=self.usersMask)
+        while request is not None:
+            response = self.execute(request)
+            for user in response.get('users', []):
+                if self.rewrite(self.sso_from(user)) is not None:
+                    yield user
+            request = users.list_next(request, response)
+
+    def rewrite(self, current):
+        # The AWS-SSO block with the old ARN replaced, or None if it doesn't
+        # mention it. Entries that end up identical are only kept once.
+        roles = []
+        values = set()
+        changed = False
+        for role in current.get('role', []):
+            parts = role['value'].split(',', 1)
+            if len(parts) == 2 and parts[self.field] == self.fromArn:
+                parts[self.field] = self.toArn
+                role = self.role_entry(parts[0], parts[1])
+                changed = True
+            if role['value'] not in values:
+                values.add(role['value'])
+                roles.append(role)
+
+        if not changed:
+            return None
+
+        block = copy.deepcopy(current)
+        block['role'] = roles
+        return block
+
+    def migrate_user(self, user):
+        # A copy of this object for one user; they all share the service
+        worker = copy.copy(self)
+        worker.userKey = user['primaryEmail']
+
+        def change(current):
+            block = self.rewrite(current)
+            if block is None:
+                return None, 'unchanged'
+            return {'customSchemas': {'AWS-SSO': block}}, 'updated'
+
+        return worker.update(change, user=user)
+
+    def run(self, dryRun=False, journal=None):
+        # Returns {userKey: status}. Users that have been migrated already
+        # don't turn up in the search again, so a journal is only needed to
+        # say what was done; users it has as done are skipped all the same.
+        users = list(self.affected())
+        if dryRun:
+            return dict((user['primaryEmail'], 'would update') for user in users)
+
+        status = {}
+        if journal is not None:
+            for user in users:
+                if journal.is_done(user['primaryEmail']):
+                    status[user['primaryEmail']] = 'done'
+            users = [user for user in users if not status.has_key(user['primaryEmail'])]
+            for user in users:
+                journal.plan(user['primaryEmail'], user.get('etag'), {'from': self.fromArn, 'to': self.toArn})
+
+        funcs = [lambda user=user: self.migrate_user(user) for user in users]
+        for user, (result, exception) in zip(users, Federator.executor().call_many(funcs)):
+            if exception is not None:
+                status[user['primaryEmail']] = "error: %s" % exception
+            else:
+                status[user['primaryEmail']] = result
+                if journal is not None:
+                    journal.complete(user['primaryEmail'], status=result)
+
+        return status
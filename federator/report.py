@@ -0,0 +1,49 @@
+#!/usr/bin/env python
+
+import csv
+import json
+from federator import User
+
+class Report(User):
+    # Domain-wide inventory of who can assume which AWS role. Everything is a
+    # generator, so only one page of users is held in memory at a time.
+
+    fields = ['user', 'role', 'provider', 'customType', 'duration']
+    formats = ['jsonl', 'csv']
+
+    # ask only for what goes into the report
+    usersMask = 'nextPageToken,users(primaryEmail,customSchemas)'
+
+    def __init__(self, customerId='my_customer', clientId=None, clientSecret=None):
+        super(Report, self).__init__(userKey=None, clientId=clientId, clientSecret=clientSecret)
+        self.customerId = customerId
+
+    def iter_roles(self):
+        # one record per (user, role, provider, duration)
+        for user in self.iter_users(customer=self.customerId, fields=self.usersMask):
+            if not (user.has_key('customSchemas') and user['customSchemas'].has_key('AWS-SSO')):
+                continue
+
+            sso = user['customSchemas']['AWS-SSO']
+            for role in sso.get('role', []):
+                roleArn, _, providerArn = role['value'].partition(',')
+                yield {
+                    'user': user['primaryEmail'],
+                    'role': roleArn,
+                    'provider': providerArn,
+                    'customType': role.get('customType'),
+                    'duration': sso.get('duration'),
+                }
+
+    def write(self, out, format='jsonl'):
+        if format not in self.formats:
+            raise ValueError("Unknown report format %s; must be one of %s" % (format, self.formats))
+
+        if format == 'csv':
+            writer = csv.DictWriter(out, self.fields)
+            writer.writeheader()
+            for record in self.iter_roles():
+                writer.writerow(record)
+        else:
+            for record in self.iter_roles():
+                out.write(json.dumps(record, sort_keys=True) + "\n")
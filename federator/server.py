@@ -0,0 +1,185 @@
+#!/usr/bin/env python
+
+from BaseHTTPServer import BaseHTTPRequestHandler
+from contextlib import contextmanager
+from googleapiclient.errors import HttpError
+from SocketServer import ThreadingMixIn, UnixStreamServer
+import errors
+import json
+import os
+import Queue
+import threading
+from federator import User, Schema
+
+# `federator serve` keeps authorised User and Schema objects (credentials,
+# discovery document, caches) warm in a long-running process and answers the
+# usual operations over HTTP on a Unix socket, so callers don't pay for
+# startup on every call. The socket lives in ~/.federator and is mode 0600,
+# so only the user who owns the credentials can talk to it.
+#
+# Requests are POSTed to /<op> with a JSON body of the same arguments the CLI
+# takes; the response is {"ok": true|false, "output": "<what the CLI prints>"}.
+
+class Pool(object):
+    # At most `size` objects in use at once; they're made on demand and
+    # reused, because neither the objects nor their Http are thread-safe
+    def __init__(self, factory, size):
+        self.factory = factory
+        self.idle = Queue.Queue()
+        self.slots = threading.BoundedSemaphore(size)
+
+    @contextmanager
+    def get(self):
+        self.slots.acquire()
+        try:
+            try:
+                obj = self.idle.get_nowait()
+            except Queue.Empty:
+                obj = self.factory()
+            yield obj
+            self.idle.put(obj)
+        finally:
+            self.slots.release()
+
+class Daemon(object):
+    ops = ['schema_verify', 'schema_show', 'user_show', 'user_add', 'user_remove', 'user_duration', 'user_edit']
+
+    def __init__(self, workers=10):
+        self.users = Pool(User, workers)
+        self.schemas = Pool(Schema, workers)
+
+        # warm up one of each now, so credential problems show up straight away
+        with self.users.get():
+            pass
+        with self.schemas.get():
+            pass
+
+    def schema_verify(self, customerid=None):
+        with self.schemas.get() as schema:
+            schema.customerId = customerid
+            if schema.exists():
+                return True, "Custom SSO schema exists"
+        return False, "Custom SSO schema does not exist"
+
+    def schema_show(self, customerid=None):
+        with self.schemas.get() as schema:
+            schema.customerId = customerid
+            if not schema.exists():
+                return False, ""
+            return True, schema.get()
+
+    def user_show(self, userkey=None):
+        with self.users.get() as user:
+            user.userKey = userkey
+            return True, user.get()
+
+    def user_add(self, userkey=None, rolearn=None, providerarn=None):
+        with self.users.get() as user:
+            user.userKey = userkey
+            if user.add_role(roleArn=rolearn, providerArn=providerarn) is None:
+                return True, "That user already has access to that role\nUpdated user %s" % userkey
+        return True, "Updated user %s" % userkey
+
+    def user_remove(self, userkey=None, rolearn=None, providerarn=None, customtype=None):
+        if customtype is None and (rolearn is None or providerarn is None):
+            return False, "You must specify either the Custom Type, or both Role and Provider ARNs"
+
+        with self.users.get() as user:
+            user.userKey = userkey
+            if customtype is not None:
+                removed = user.remove_role(customType=customtype)
+            else:
+                removed = user.remove_role(roleArn=rolearn, providerArn=providerarn)
+
+        if removed:
+            return True, "Removed role %s from user %s" % (removed, userkey)
+        return False, "Could not remove role from user %s" % userkey
+
+    def user_duration(self, userkey=None, duration=None):
+        with self.users.get() as user:
+            user.userKey = userkey
+            user.set_duration(duration=duration)
+        return True, ""
+
+    def user_edit(self, userkey=None, add=None, remove=None, duration=None):
+        with self.users.get() as user:
+            user.userKey = userkey
+            try:
+                edit = user.edit().options(add=add, remove=remove, duration=duration)
+            except ValueError as err:
+                return False, str(err)
+            changes = edit.commit()
+
+        return True, "\n".join(changes) or "No changes to user %s" % userkey
+
+    def call(self, op, args):
+        if op not in self.ops:
+            raise KeyError(op)
+        return getattr(self, op)(**args)
+
+class Handler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, format, *args):
+        # client_address is meaningless on a Unix socket
+        pass
+
+    def respond(self, status, body):
+        content = json.dumps(body)
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(content)))
+        self.end_headers()
+        self.wfile.write(content)
+
+    def do_POST(self):
+        op = self.path.strip('/')
+        length = int(self.headers.get('content-length', 0))
+        try:
+            args = json.loads(self.rfile.read(length)) if length else {}
+            args = dict((str(key), value) for key, value in args.items())
+        except ValueError:
+            return self.respond(400, {'ok': False, 'output': "Request body is not JSON"})
+
+        try:
+            ok, output = self.server.daemon.call(op, args)
+        except KeyError:
+            return self.respond(404, {'ok': False, 'output': "Unknown operation %s" % op})
+        except TypeError as err:
+            return self.respond(400, {'ok': False, 'output': str(err)})
+        except HttpError as err:
+            return self.respond(502, {'ok': False, 'output': "Google API error: %s" % err})
+        except errors.FederatorError as err:
+            return self.respond(200, {'ok': False, 'output': str(err)})
+
+        self.respond(200, {'ok': bool(ok), 'output': output})
+
+class Server(ThreadingMixIn, UnixStreamServer):
+    daemon_threads = True
+    # many short CLI calls can arrive at once; SocketServer's default
+    # backlog of 5 turns most of them away
+    request_queue_size = 128
+
+    def __init__(self, path, daemon):
+        if os.path.exists(path):
+            os.unlink(path)
+
+        # create the socket with no access for anyone else from the start
+        umask = os.umask(0177)
+        try:
+            UnixStreamServer.__init__(self, path, Handler)
+        finally:
+            os.umask(umask)
+        self.daemon = daemon
+
+    def server_close(self):
+        UnixStreamServer.server_close(self)
+        if os.path.exists(self.server_address):
+            os.unlink(self.server_address)
+
+def serve(path, workers=10):
+    server = Server(path, Daemon(workers=workers))
+    try:
+        server.serve_forever()
+    finally:
+        server.server_close()
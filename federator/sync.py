@@ -0,0 +1,135 @@
+#!/usr/bin/env python
+
+import compact
+import errors
+import json
+from bulk import Bulk
+
+class Sync(Bulk):
+    # Reconcile the AWS-SSO roles in the domain against a desired-state file:
+    #
+    #   {
+    #       "alice@example.com": {
+    #           "roles": [
+    #               {"role": "arn:aws:iam::...:role/Admin", "provider": "arn:aws:iam::...:saml-provider/Google"}
+    #           ],
+    #           "duration": 3600
+    #       }
+    #   }
+    #
+    # The current state of the whole domain is read in one paginated pass
+    # into a compact snapshot, diffed against the desired state in one merge
+    # pass, and exactly one patch (batched) is sent per user that needs to
+    # change.
+
+    def __init__(self, customerId='my_customer', clientId=None, clientSecret=None, batchSize=None):
+        super(Sync, self).__init__(clientId=clientId, clientSecret=clientSecret, batchSize=batchSize)
+        self.customerId = customerId
+        self.etags = {}
+        # users whose duration in the plan is just the one they already had
+        self.keptDurations = set()
+
+    @staticmethod
+    def read_desired(path):
+        with open(path) as desired:
+            return json.load(desired)
+
+    def desired_block(self, userKey, spec):
+        # Turn one user's entry in the desired-state file into an AWS-SSO block
+        roles = []
+        for role in spec.get('roles', []):
+            try:
+                self.match_arns(role.get('role'), role.get('provider'))
+            except errors.InvalidArn as err:
+                raise errors.InvalidArn("Invalid ARN for user %s: %s (%s)" % (userKey, role, err))
+            entry = self.role_entry(role['role'], role['provider'])
+            if entry not in roles:
+                roles.append(entry)
+
+        block = {'role': roles}
+        if spec.has_key('duration'):
+            block['duration'] = int(spec['duration'])
+
+        return block
+
+    def current_state(self):
+        # A compact.Snapshot of every user that has an AWS-SSO block, with
+        # the etags seen, so that a directory of hundreds of thousands of
+        # users fits in a modest amount of memory
+        current = compact.Snapshot()
+        for user in self.iter_users(customer=self.customerId,
+                fields='nextPageToken,users(primaryEmail,etag,customSchemas)'):
+            if user.has_key('customSchemas') and user['customSchemas'].has_key('AWS-SSO'):
+                current.add(user['primaryEmail'].lower(), user['customSchemas']['AWS-SSO'], etag=user.get('etag'))
+
+        return current.freeze()
+
+    def plan(self, desired, current, prune=False):
+        # Returns a list of (userKey, changes, patch); changes is a list of
+        # human-readable lines for the plan. current is a compact.Snapshot.
+        wanted = compact.Snapshot(current.roles)
+        for userKey, spec in desired.items():
+            wanted.add(userKey.lower(), self.desired_block(userKey, spec))
+        wanted.freeze()
+
+        self.etags = {}
+        self.keptDurations = set()
+        plan = []
+        for userKey, i, j, added, removed in current.diff(wanted, prune=prune):
+            have = current.duration(i)
+            want = wanted.duration(j)
+
+            changes = []
+            for value, customType in sorted(current.roles.value(id) for id in added):
+                changes.append("+ %s (%s)" % (value, customType))
+            for value, customType in sorted(current.roles.value(id) for id in removed):
+                changes.append("- %s (%s)" % (value, customType))
+            # only mention the duration if someone asked for it and it differs
+            # from what the user already has
+            if want is not None and want != have:
+                changes.append("~ duration %s -> %s" % (have, want))
+
+            if changes:
+                block = wanted.block(j) if j is not None else {'role': []}
+                if want is None:
+                    block['duration'] = have if have is not None else 3600
+                    self.keptDurations.add(userKey)
+                if i is not None:
+                    self.etags[userKey] = current.etags[i]
+                plan.append((userKey, changes, {'customSchemas': {'AWS-SSO': block}}))
+
+        return plan
+
+    def apply(self, plan, journal=None):
+        # With a journal, users it says are done are skipped. Everyone else is
+        # re-planned from the fresh read of the domain anyway, so a patch that
+        # was in flight when a run died either shows up again or doesn't.
+        # Patches only apply to users that haven't changed since the scan;
+        # any that have are read again and re-checked against the plan.
+        status = {}
+        patches = []
+        for userKey, changes, patch in plan:
+            if journal is not None and journal.is_done(userKey):
+                status[userKey] = 'done'
+                continue
+            patches.append((userKey, patch))
+
+        wanted = dict(patches)
+        def replan(userKey, user):
+            block = dict(wanted[userKey]['customSchemas']['AWS-SSO'])
+            current = self.sso_from(user)
+            if userKey in self.keptDurations:
+                block['duration'] = current.get('duration', 3600)
+            if self.same_block(current, block):
+                return None
+            return {'customSchemas': {'AWS-SSO': block}}
+
+        etags = dict((userKey, self.etags.get(userKey)) for userKey, patch in patches)
+        status.update(self.send(patches, etags, replan, journal=journal))
+        return status
+
+    @staticmethod
+    def same_block(current, wanted):
+        # The same roles (in any order) and duration
+        values = lambda block: sorted((role['value'], role.get('customType')) for role in block.get('role', []))
+        return values(current) == values(wanted) and current.get('duration') == wanted.get('duration')
@@ -0,0 +1,67 @@
+#!/usr/bin/env python
+
+import json
+from federator import Federator, Schema
+
+class Tenants(object):
+    # Run schema operations across many Google Apps customers at once. The
+    # tenants file lists each customer ID with the credential profile to use
+    # for it (see `federator --profile <name> init`):
+    #
+    #   [
+    #       {"customerId": "C01abcdef", "profile": "acme"},
+    #       {"customerId": "C02ghijkl", "profile": "globex"}
+    #   ]
+
+    ops = ['verify', 'create', 'show']
+
+    def __init__(self, tenants):
+        self.tenants = tenants
+
+    @classmethod
+    def read_tenants(cls, path):
+        with open(path) as tenants:
+            tenants = json.load(tenants)
+
+        for tenant in tenants:
+            if not tenant.get('customerId'):
+                raise ValueError("Tenant %s has no customerId" % tenant)
+
+        return cls(tenants)
+
+    @staticmethod
+    def verify(schema):
+        return {'exists': schema.exists()}
+
+    @staticmethod
+    def create(schema):
+        if schema.exists():
+            return {'exists': True, 'created': False}
+        return {'exists': True, 'created': schema.create()}
+
+    @staticmethod
+    def show(schema):
+        return {'exists': schema.exists(), 'schema': schema.fetch()}
+
+    def run(self, op):
+        # Returns one result per tenant, in the order they were listed:
+        # {'customerId', 'profile', 'ok', and the op's result or 'error'}
+        if op not in self.ops:
+            raise ValueError("Unknown operation %s; must be one of %s" % (op, self.ops))
+
+        def call(tenant):
+            schema = Schema(customerId=tenant['customerId'], profile=tenant.get('profile'))
+            return getattr(self, op)(schema)
+
+        funcs = [lambda tenant=tenant: call(tenant) for tenant in self.tenants]
+        results = []
+        for tenant, (result, exception) in zip(self.tenants, Federator.executor().call_many(funcs)):
+            record = {'customerId': tenant['customerId'], 'profile': tenant.get('profile')}
+            if exception is not None:
+                record.update({'ok': False, 'error': str(exception)})
+            else:
+                record.update(result)
+                record['ok'] = result['exists']
+            results.append(record)
+
+        return results
@@ -0,0 +1,51 @@
+#!/usr/bin/env python
+
+import Queue
+import threading
+
+class PooledHttp(object):
+    # Looks enough like an httplib2.Http for the Google API client, but hands
+    # each request to one of a pool of authorised Http objects, so a single
+    # service object can be used from many threads at once. httplib2.Http
+    # itself isn't thread-safe, but it does keep its connections alive, so
+    # reusing a small pool of them amortises the TLS handshakes across every
+    # call. At most `size` requests are in flight at once; others wait.
+
+    def __init__(self, factory, size=10, credentials=None):
+        self.factory = factory
+        self.size = size
+        # the API client looks here when it needs to authorise batch parts
+        self.credentials = credentials
+        # LIFO, so the most recently used (and still connected) Http goes next
+        self.idle = Queue.LifoQueue()
+        self.created = 0
+        self.lock = threading.Lock()
+
+    def checkout(self):
+        try:
+            return self.idle.get_nowait()
+        except Queue.Empty:
+            pass
+
+        with self.lock:
+            if self.created < self.size:
+                self.created += 1
+                return self.factory()
+
+        return self.idle.get()
+
+    def request(self, *args, **kwargs):
+        http = self.checkout()
+        try:
+            return http.request(*args, **kwargs)
+        finally:
+            self.idle.put(http)
+
+    def close(self):
+        while True:
+            try:
+                http = self.idle.get_nowait()
+            except Queue.Empty:
+                return
+            for connection in getattr(http, 'connections', {}).values():
+                connection.close()
@@ -0,0 +1,230 @@
+#!/usr/bin/env python
+
+from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+from googleapiclient.errors import HttpError
+import binascii
+import cache
+import index
+import json
+import os
+import sys
+import time
+import uuid
+from federator import User
+
+class Watcher(User):
+    # Keep the local user cache and role index up to date from Directory API
+    # push notifications (users.watch) rather than re-reading the directory.
+    # Google POSTs to `address` (which must be HTTPS, e.g. a reverse proxy in
+    # front of the Receiver below) whenever a user is added, changed or
+    # deleted, and only that user is re-read. Channels expire, so they're
+    # renewed before they do; while there are none (or they can't be
+    # created), the index is polled incrementally instead.
+
+    events = ['add', 'update', 'delete', 'undelete']
+
+    # Google won't keep a Directory channel open for more than six hours
+    channelTtl = 21600
+    # renew this long before the channels expire
+    renewMargin = 600
+    # how often to poll, or to retry creating channels, when there are none
+    pollInterval = 300
+
+    userMask = 'primaryEmail,etag,customSchemas'
+
+    def __init__(self, address, customerId='my_customer', clientId=None, clientSecret=None):
+        super(Watcher, self).__init__(userKey=None, clientId=clientId, clientSecret=clientSecret)
+        self.address = address
+        self.customerId = customerId
+        self.index = index.RoleIndex(self.store)
+        self.channelFile = os.path.join(self.store, 'channels.json')
+        self.channels = self.load_channels()
+        # channels that are being started, and ones that have just been
+        # replaced: notifications sent on them are still ours (the receiver
+        # may only get to them once the renewal is over)
+        self.starting = []
+        self.retired = []
+        self.lastPoll = 0
+        self.nextRenew = 0
+
+    def load_channels(self):
+        try:
+            with open(self.channelFile) as channels:
+                return json.load(channels)
+        except (IOError, ValueError):
+            return []
+
+    def save_channels(self):
+        cache.atomic_write(self.channelFile, json.dumps(self.channels))
+
+    def start_channels(self):
+        # One channel for each kind of change, all with the same secret token.
+        # If one can't be made, the ones that were are stopped again rather
+        # than left running with nobody keeping track of them.
+        token = binascii.hexlify(os.urandom(16))
+        channels = self.starting = []
+        try:
+            for event in self.events:
+                body = {'id': str(uuid.uuid4()), 'type': 'web_hook', 'address': self.address,
+                        'token': token, 'params': {'ttl': str(self.channelTtl)}}
+                request = self.service.users().watch(customer=self.customerId, event=event,
+                        projection='custom', customFieldMask='AWS-SSO', body=body)
+                channel = self.execute(request)
+                expiration = int(channel.get('expiration', 0)) / 1000.0 or time.time() + self.channelTtl
+                channels.append({'id': channel['id'], 'resourceId': channel['resourceId'],
+                                 'token': token, 'event': event, 'expiration': expiration})
+        except:
+            self.stop_channels(channels)
+            self.starting = []
+            raise
+
+        return channels
+
+    def stop_channels(self, channels):
+        for channel in channels:
+            request = self.service.channels().stop(body={'id': channel['id'], 'resourceId': channel['resourceId']})
+            try:
+                self.execute(request)
+            except HttpError:
+                # it's gone already
+                pass
+
+    def expires(self):
+        # When the first of our channels expires; 0 if there are none
+        if not self.channels:
+            return 0
+        return min(channel['expiration'] for channel in self.channels)
+
+    def live(self):
+        return self.expires() > time.time()
+
+    def renew(self):
+        # Replace the channels if they're close to expiring. If new ones
+        # can't be made, the old ones run out and polling takes over until a
+        # later attempt works. Notifications on the old channels are accepted
+        # until they would have expired, and the index is polled afterwards
+        # in case anything fell between the two sets.
+        now = time.time()
+        if self.expires() - now > self.renewMargin or now < self.nextRenew:
+            return
+
+        try:
+            channels = self.start_channels()
+        except HttpError as err:
+            sys.stderr.write("Could not start watching users (%s); polling every %ds\n" % (err, self.pollInterval))
+            self.nextRenew = now + self.pollInterval
+            return
+
+        old, self.channels = self.channels, channels
+        self.retired = [channel for channel in self.retired + old if channel['expiration'] > now]
+        self.starting = []
+        self.save_channels()
+        self.stop_channels(old)
+        self.poll()
+
+    def poll(self):
+        # Bring the index up to date the slow way; only users whose etag has
+        # changed are rewritten. Returns their keys.
+        changed = []
+        self.index.refresh(self, customer=self.customerId, changed=changed)
+        for userKey in changed:
+            self.cache.invalidate(userKey)
+        self.lastPoll = time.time()
+        return changed
+
+    def tick(self):
+        # Call regularly, e.g. whenever the receiver has been idle a second
+        self.renew()
+        if not self.live() and time.time() - self.lastPoll >= self.pollInterval:
+            self.poll()
+
+    def notify(self, headers, body):
+        # Handle one push notification; headers have lower-case names.
+        # Returns False if it didn't come from one of our channels.
+        channelId = headers.get('x-goog-channel-id')
+        channels = [channel for channel in self.channels + self.starting + self.retired
+                    if channel['id'] == channelId]
+        if not channels or headers.get('x-goog-channel-token') != channels[0]['token']:
+            return False
+
+        state = headers.get('x-goog-resource-state')
+        if state == 'sync':
+            # sent once when a channel starts
+            return True
+
+        user = json.loads(body) if body else {}
+        userKey = user.get('primaryEmail', '').lower()
+        if not userKey:
+            return True
+
+        self.cache.invalidate(userKey)
+        if state == 'delete':
+            self.index.remove_user(userKey)
+        elif user.get('etag') is None or user['etag'] != self.index.etag(userKey):
+            self.refresh_user(userKey)
+        self.index.db.commit()
+        return True
+
+    def refresh_user(self, userKey):
+        request = self.service.users().get(userKey=userKey, projection='custom',
+                customFieldMask='AWS-SSO', fields=self.userMask)
+        try:
+            user = self.execute(request)
+        except HttpError as err:
+            if int(err.resp.status) != 404:
+                raise
+            self.index.remove_user(userKey)
+            return
+
+        self.index.store_user(userKey, user)
+
+    def close(self):
+        self.stop_channels(self.channels)
+        self.channels = []
+        self.save_channels()
+
+class NotificationHandler(BaseHTTPRequestHandler):
+    def log_message(self, format, *args):
+        pass
+
+    def respond(self, status):
+        self.send_response(status)
+        self.send_header('Content-Length', '0')
+        self.end_headers()
+
+    def do_POST(self):
+        length = int(self.headers.get('content-length', 0))
+        body = self.rfile.read(length) if length else ''
+        headers = dict((key.lower(), value) for key, value in self.headers.items())
+        try:
+            ok = self.server.watcher.notify(headers, body)
+        except (HttpError, ValueError) as err:
+            # Google retries notifications that fail
+            sys.stderr.write("Could not handle notification: %s\n" % err)
+            return self.respond(500)
+
+        self.respond(200 if ok else 403)
+
+class Receiver(HTTPServer):
+    # Handles one notification at a time, on the same thread as the
+    # watcher's housekeeping, because the SQLite index isn't shared between
+    # threads
+    timeout = 1
+
+    def __init__(self, address, watcher):
+        HTTPServer.__init__(self, address, NotificationHandler)
+        self.watcher = watcher
+
+def watch(watcher, listen=('127.0.0.1', 8088)):
+    receiver = Receiver(listen, watcher)
+    # notifications may have been missed since the last run
+    watcher.renew()
+    if not watcher.lastPoll:
+        watcher.poll()
+    try:
+        while True:
+            receiver.handle_request()
+            watcher.tick()
+    finally:
+        receiver.server_close()
+        watcher.close()
@@ -78,7 +78,7 @@ setup(
     # requirements files see:
     # https://packaging.python.org/en/latest/requirements.html
     # install_requires=['peppercorn'],
-    install_requires=['google-api-python-client', 'oauth2client', 'pycrypto'],
+    install_requires=['google-api-python-client', 'oauth2client', 'pycrypto', 'futures'],
 
     # List additional groups of dependencies here (e.g. development
     # dependencies). You can install these using the following syntax,
@@ -88,6 +88,9 @@ setup(
     #     'dev': ['check-manifest'],
     #     'test': ['coverage'],
     # },
+    extras_require={
+        'iam': ['boto3'],
+    },
 
     # If there are data files included in your packages that need to be
     # installed, specify them here.  If using Python 2.6 or less, then these
@@ -95,6 +98,9 @@ setup(
     # package_data={
     #     'sample': ['package_data.dat'],
     # },
+    package_data={
+        'federator': ['documents/*.json'],
+    },
 
     # Although 'package_data' is the preferred approach, in some case you may
     # need to place data files outside of your packages. See: